@@ -0,0 +1,78 @@
+from email.utils import formatdate
+import os
+import threading
+import time
+
+import requests
+
+import hosts
+import stats_file
+
+# Artwork for the series/season folders. Images that are already on disk are left alone until they
+# are due for a recheck, and then only revalidated (ETag / Last-Modified) instead of downloaded again.
+# New files are written to a temp file and renamed so Jellyfin never reads half an image.
+
+RECORDS_PATH = os.path.join("cache", "artwork.json")
+RECHECK_SECONDS = 7 * 24 * 60 * 60
+REQUEST_TIMEOUT = 15
+
+TMDB_IMAGE_BASE = "https://image.tmdb.org/t/p"
+TMDB_SIZE = "original"  # Override with "tmdbImageSize" in config.json, e.g. "w1280"
+
+def tmdb_url(path, size=TMDB_SIZE):
+    if not path:
+        return None
+    return f"{TMDB_IMAGE_BASE}/{size}{path}"
+
+def save_record(dest, record):
+    stats_file.update(RECORDS_PATH, lambda records: records.update({os.path.abspath(dest): record}),
+                      "artwork records")
+
+def write_atomic(dest, content):
+    temp_path = f"{dest}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(content)
+    os.replace(temp_path, dest)
+
+def fetch_image(url, dest):
+    # Returns "downloaded", "unchanged", "skipped" or "failed"
+    if not url:
+        print(f"[!] No URL provided for image: {dest}")
+        return "failed"
+
+    record = stats_file.load(RECORDS_PATH).get(os.path.abspath(dest))
+    exists = os.path.exists(dest)
+    if exists and record and record.get("url") == url and time.time() - record.get("checked_at", 0) < RECHECK_SECONDS:
+        return "skipped"
+
+    headers = {}
+    if exists and record and record.get("url") == url:
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+    elif exists and not record:
+        # Written before the records existed, the file's own age is the best validator we have
+        headers["If-Modified-Since"] = formatdate(os.path.getmtime(dest), usegmt=True)
+
+    try:
+        response = requests.get(hosts.rewrite(url), headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            record = record or {"url": url}
+            record["checked_at"] = time.time()
+            save_record(dest, record)
+            return "unchanged"
+        response.raise_for_status()
+        write_atomic(dest, response.content)
+        save_record(dest, {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked_at": time.time(),
+            "bytes": len(response.content),
+        })
+        print(f"[OK] Downloaded image to {dest}")
+        return "downloaded"
+    except Exception as e:
+        print(f"[X] Failed to download image {url}: {e}")
+        return "failed"
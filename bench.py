@@ -0,0 +1,394 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import browser_pool
+import db
+import jellyfin
+import metrics
+from engine import DownloadEngine
+from job_queue import PRIORITY_INTERACTIVE
+from transfer import format_bytes
+
+# Offline benchmark of the whole download pipeline. A local server stands in for miruro.to (watch
+# page and /api/info, /api/episodes), pahe.win, kwik.si, the image hosts and Jellyfin, with the same
+# selectors download.py waits for. hostOverrides points every site at it, so the browser and the
+# transfer run exactly as they do against the real sites, minus the network.
+#
+# Everything runs in a temporary working directory with its own config.json, hue.db, output and
+# resident browsers (on their own ports), so a running bot and its library are never touched. Each
+# scenario is reported from the stage timings download.py writes to the metrics table (metrics.py).
+#
+#   python bench.py                                   all scenarios with a 50 MB episode
+#   python bench.py --scenarios single --runs 5 --save before.json
+#   python bench.py --scenarios single --runs 5 --compare before.json
+
+SITES = ["www.miruro.to", "pahe.win", "kwik.si", "image.tmdb.org", "s4.anilist.co"]
+BENCH_PROFILES = {
+    "miruro": {"user_data_dir": "chromium_bench", "port": 9331},
+    "kwik": {"user_data_dir": "chromium_bench_kwik", "port": 9332},
+}
+SCENARIOS = ("single", "range", "concurrent")
+FIRST_SERIES_ID = 900001
+CHUNK = bytes(range(256)) * 256  # 64 KiB, repeated to make up the video
+PIXEL = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+def miruro_page(series_id, episode, episodes, latency_ms):
+    # Like the real SPA it follows history changes, re-rendering the episode after an API round trip
+    return f'''<!DOCTYPE html>
+<html><head><title>Bench Series {series_id}</title></head><body>
+<div class="title anime-title"><a href="/info/{series_id}">Bench Series {series_id}</a></div>
+<div class="title-container"><span class="ep-number">Episode {episode}</span> <span class="ep-title">Bench Episode {episode}</span></div>
+<div class="t4mg1tz">
+  <p>Episodes: {episodes} / {episodes}</p>
+  <p>Status: Finished</p>
+  <div style="display: flex; flex-wrap: wrap"><a>Action</a><a>Fantasy</a></div>
+  <a href="https://myanimelist.net/anime/{series_id}">MyAnimeList</a>
+</div>
+<div class="r1s34uq0">
+  <div><div>Sub</div><button class="b1nm6r8">zoro</button><button class="b1nm6r8" id="kiwi">kiwi</button></div>
+</div>
+<button title="Download Episode" onclick="window.open('https://pahe.win/{series_id}-' + currentEpisode())">Download Episode</button>
+<script>
+function currentEpisode() {{
+    return new URLSearchParams(location.search).get("ep") || "1";
+}}
+window.addEventListener("popstate", function () {{
+    setTimeout(function () {{
+        document.querySelector(".ep-number").textContent = "Episode " + currentEpisode();
+        document.querySelector(".ep-title").textContent = "Bench Episode " + currentEpisode();
+        // The sources load after the episode info, and the download control is rendered again with them
+        setTimeout(function () {{
+            var old = document.querySelector('button[title="Download Episode"]');
+            var button = document.createElement("button");
+            button.title = "Download Episode";
+            button.textContent = "Download Episode";
+            button.onclick = old.onclick;
+            old.replaceWith(button);
+        }}, {latency_ms});
+    }}, {latency_ms});
+}});
+document.getElementById("kiwi").onclick = function () {{
+    var button = this;
+    setTimeout(function () {{ button.classList.add("active"); }}, 50);
+}};
+</script>
+</body></html>'''
+
+def pahe_page(token, delay_ms):
+    # pahe.win shows its link after a countdown
+    return f'''<!DOCTYPE html>
+<html><body><p>Redirecting...</p>
+<script>
+setTimeout(function () {{
+    var link = document.createElement("a");
+    link.className = "redirect";
+    link.href = "https://kwik.si/f/{token}";
+    link.textContent = "Continue";
+    document.body.appendChild(link);
+}}, {delay_ms});
+</script>
+</body></html>'''
+
+def kwik_page(token, delay_ms):
+    # The form only shows up once the bot check button was clicked
+    return f'''<!DOCTYPE html>
+<html><body>
+<button class="btn btn-primary btn-captcha" onclick="verify()">I'm not a robot</button>
+<div id="form"></div>
+<script>
+function verify() {{
+    setTimeout(function () {{
+        document.getElementById("form").innerHTML =
+            '<form action="https://kwik.si/d/{token}" method="POST">' +
+            '<input type="hidden" name="_token" value="csrf-{token}"><button type="submit">Download</button></form>';
+    }}, {delay_ms});
+}}
+</script>
+</body></html>'''
+
+def anilist_info(series_id, episodes):
+    return {
+        "id": int(series_id),
+        "title": {"english": f"Bench Series {series_id}", "romaji": f"Bench Series {series_id}"},
+        "status": "FINISHED",
+        "episodes": episodes,
+        "genres": ["Action", "Fantasy"],
+        "isAdult": False,
+        "description": "Stand-in series for bench.py.",
+        "averageScore": 80,
+        "startDate": {"year": 2024},
+        "coverImage": {"extraLarge": f"https://s4.anilist.co/img/{series_id}/cover.png"},
+        "bannerImage": f"https://s4.anilist.co/img/{series_id}/banner.png",
+    }
+
+def episode_list(series_id, episodes):
+    return {"TMDB": {str(series_id): {"metadata": {
+        "tvShowDetails": {"show": {"backdrop_path": f"/{series_id}/backdrop.png"}},
+        "episodes": [{"number": number, "title": f"Bench Episode {number}", "airDate": "2024-01-01",
+                      "description": "", "image": f"https://image.tmdb.org/t/p/original/{series_id}/{number}.png"}
+                     for number in range(1, episodes + 1)],
+    }}}}
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real sites
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="text/html; charset=utf-8", headers=None, delay=True):
+        if delay and self.server.latency:
+            time.sleep(self.server.latency)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, document):
+        self.send_body(200, json.dumps(document), "application/json")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path = url.path
+        series_id = query.get("id", query.get("malId", ["0"]))[0]
+        episodes = self.server.episodes
+        if path == "/watch":
+            self.send_body(200, miruro_page(series_id, int(query.get("ep", ["1"])[0]), episodes, int(self.server.latency * 1000)))
+        elif path.startswith("/api/info/anilist/"):
+            self.send_json(anilist_info(path.rsplit("/", 1)[-1], episodes))
+        elif path == "/api/episodes":
+            self.send_json(episode_list(series_id, episodes))
+        elif path.startswith("/f/"):
+            self.send_body(200, kwik_page(path[3:], self.server.redirect_delay_ms))
+        elif path.startswith("/files/"):
+            self.send_video(path)
+        elif path.endswith(".png"):
+            self.send_body(200, PIXEL, "image/png", delay=False)
+        elif re.fullmatch(r"/\d+-\d+", path):
+            self.send_body(200, pahe_page(path[1:], self.server.redirect_delay_ms))
+        else:
+            self.send_body(404, "Not found")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        path = urlsplit(self.path).path
+        if path.startswith("/d/"):
+            token = path[3:]
+            if form.get("_token") != [f"csrf-{token}"]:
+                self.send_body(419, "<html>Page expired</html>")  # kwik answers a bad token with a page
+                return
+            self.send_body(302, "", headers={"Location": f"/files/{token}.mp4"})
+        elif path.startswith("/Library/"):
+            self.send_body(204, "", delay=False)  # Jellyfin refresh
+        else:
+            self.send_body(404, "Not found")
+
+    def send_video(self, path):
+        size = self.server.size
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_body(416, "", headers={"Content-Range": f"bytes */{size}"}, delay=False)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{os.path.basename(path)}-{size}"')
+        self.end_headers()
+
+        # Same bytes for the same offset, so resumed and segmented files come out identical
+        rate = self.server.rate
+        started = time.monotonic()
+        sent = 0
+        position = start
+        try:
+            while position <= end:
+                offset = position % len(CHUNK)
+                piece = CHUNK[offset:offset + min(len(CHUNK) - offset, end - position + 1)]
+                self.wfile.write(piece)
+                position += len(piece)
+                sent += len(piece)
+                if rate:
+                    ahead = sent / rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client gave up on the transfer
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args):
+        super().__init__(("127.0.0.1", args.port), StandInHandler)
+        self.size = int(args.size * 1024 * 1024)
+        self.rate = int(args.rate * 1024 * 1024)
+        self.latency = args.latency / 1000
+        self.redirect_delay_ms = args.redirect_delay
+        self.episodes = max(args.episodes, 1)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+def prepare_workdir(workdir, server, args):
+    config = {
+        "outputDir": "./output",
+        "retryDelay": 1,
+        "maxEpisodes": max(30, args.episodes),
+        "maxConcurrentDownloads": args.concurrency,
+        "downloadSegments": args.segments,
+        "banNSFW": True,
+        "headless": True,
+        "hostOverrides": {site: server.base_url for site in SITES},
+    }
+    with open(os.path.join(workdir, "config.json"), "w") as file:
+        json.dump(config, file, indent=4)
+    os.chdir(workdir)
+    os.environ["JELLYFIN_API_URL"] = server.base_url
+    browser_pool.PROFILES.update(BENCH_PROFILES)  # Never attach to the bot's resident browsers
+
+def scenario_jobs(name, args, series_ids):
+    # Returns (url, episode, episodes) for each job of the scenario
+    def url(series_id):
+        return f"https://www.miruro.to/watch?id={series_id}&ep=1"
+    if name == "single":
+        return [(url(next(series_ids)), 1, None)]
+    if name == "range":
+        return [(url(next(series_ids)), None, f"1-{args.episodes}")]
+    return [(url(next(series_ids)), 1, None) for _ in range(args.concurrency)]
+
+async def run_scenario(engine, name, args, series_ids):
+    walls, job_ids, failed, episodes = [], [], 0, 0
+    for run in range(args.runs):
+        jobs = scenario_jobs(name, args, series_ids)
+        print(f"[*] Bench: {name} run {run + 1}/{args.runs} ({len(jobs)} job(s))")
+        started = time.monotonic()
+        submitted = [await engine.submit(url, episode=episode, episodes=episode_range, kind="bench", priority=PRIORITY_INTERACTIVE)
+                     for url, episode, episode_range in jobs]
+        codes = await asyncio.gather(*(job.task for job in submitted))
+        walls.append(time.monotonic() - started)
+        job_ids += [job.job_id for job in submitted]
+        failed += sum(1 for code in codes if code != 0)
+        episodes += sum(job.episode_range[1] - job.episode_range[0] + 1 for job, code in zip(submitted, codes)
+                        if code == 0 and job.episode_range)
+    wall = statistics.median(walls)
+    stages = await db.run(metrics.stage_summary, 1, job_ids)
+    return {
+        "scenario": name,
+        "runs": args.runs,
+        "failed_jobs": failed,
+        "episodes": episodes,
+        "wall": wall,
+        "throughput": episodes * args.size * 1024 * 1024 / max(sum(walls), 1e-6),
+        "stages": stages,
+    }
+
+async def run_benchmark(args):
+    engine = DownloadEngine()
+    series_ids = iter(range(FIRST_SERIES_ID, FIRST_SERIES_ID + 100000))
+    return [await run_scenario(engine, name, args, series_ids) for name in args.scenarios]
+
+def summarize(results, baseline=None):
+    previous = {result["scenario"]: result for result in (baseline or {}).get("results", [])}
+    lines = []
+    for result in results:
+        before = previous.get(result["scenario"])
+        change = ""
+        if before and before["wall"]:
+            change = f" ({(result['wall'] - before['wall']) / before['wall']:+.0%} vs baseline)"
+        lines.append(f"{result['scenario']}: {result['wall']:.1f}s median wall over {result['runs']} run(s){change}, "
+                     f"{result['episodes']} episode(s), {format_bytes(result['throughput'])}/s, "
+                     f"{result['failed_jobs']} failed job(s)")
+        lines += metrics.stage_lines(result["stages"])
+        if before:
+            old_stages = {entry["stage"]: entry for entry in before["stages"]}
+            for entry in result["stages"]:
+                old = old_stages.get(entry["stage"])
+                if old and old.get("p50") and entry["p50"] is not None:
+                    lines.append(f"    {entry['stage']:<14} p50 {old['p50']:.2f}s -> {entry['p50']:.2f}s "
+                                 f"({(entry['p50'] - old['p50']) / old['p50']:+.0%})")
+    return "\n".join(lines)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline against local stand-ins for miruro, pahe.win and kwik.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), help="Scenarios to run (default: all)")
+    parser.add_argument("--runs", type=int, default=1, help="Times each scenario is repeated (default: %(default)s)")
+    parser.add_argument("--size", type=float, default=50, help="Episode size in MB (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=0, help="Per connection limit in MB/s, 0 for none (default: %(default)s)")
+    parser.add_argument("--latency", type=int, default=50, help="Delay before each page and API answer in ms (default: %(default)s)")
+    parser.add_argument("--redirect-delay", type=int, default=500,
+                        help="pahe.win countdown and kwik bot check delay in ms (default: %(default)s)")
+    parser.add_argument("--episodes", type=int, default=5, help="Episodes in the range scenario (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=3,
+                        help="Jobs in the concurrent scenario, also maxConcurrentDownloads (default: %(default)s)")
+    parser.add_argument("--segments", type=int, default=4, help="downloadSegments (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=0, help="Port of the stand-in server (default: any free port)")
+    parser.add_argument("--save", metavar="PATH", help="Write the results as JSON, to compare against later")
+    parser.add_argument("--compare", metavar="PATH", help="Show the change against results saved with --save")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory")
+    return parser.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+    save_path = os.path.abspath(args.save) if args.save else None
+
+    server = StandInServer(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[*] Stand-in sites on {server.base_url}")
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="hue-bench-")
+    try:
+        prepare_workdir(workdir, server, args)
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        jellyfin.REFRESH.flush()
+        try:
+            browser_pool.shutdown()
+        except Exception as e:
+            print(f"[!] Could not stop the bench browsers: {e}")
+        os.chdir(home)
+        server.shutdown()
+        if args.keep:
+            print(f"[*] Working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(summarize(results, baseline))
+    if save_path:
+        settings = {key: value for key, value in vars(args).items() if key not in ("save", "compare", "keep", "port")}
+        with open(save_path, "w") as file:
+            json.dump({"settings": settings, "results": results}, file, indent=4)
+        print(f"[OK] Results saved to {save_path}")
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
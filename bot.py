@@ -1,18 +1,23 @@
 import os
-import subprocess
 import discord
 import json
-import shlex
 import asyncio
-import sqlite3
 import re
 import datetime
-import requests
 
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 
+import db
+import jellyfin
+import metrics
+from engine import DownloadEngine
+from job_queue import PRIORITY_INTERACTIVE, PRIORITY_SCHEDULED, PRIORITY_BACKFILL
+from live_status import LiveStatus
+from notifier import NotificationDispatcher
+from scheduler import AirtimeScheduler, lag_summary, parse_time, record_lag
+
 # TODO: Improve error handling and logging
 # TODO: Add a check to ensure that download_failed does not get marked as True if it is trying to download next_episode before the air time
 # TODO: Pull any failed episode downloads and retry if it makes sense to
@@ -22,7 +27,6 @@ from dotenv import load_dotenv
 load_dotenv()
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 JELLYFIN_URL = os.getenv("JELLYFIN_URL")
-JELLYFIN_API_KEY = os.getenv("JELLYFIN_API_KEY")
 
 intents = discord.Intents.default()
 bot = commands.Bot(command_prefix="!", intents=intents)
@@ -35,6 +39,9 @@ def load_config(path):
 
 CONFIG_PATH = "config.json"
 CONFIG = load_config(CONFIG_PATH)
+ENGINE = DownloadEngine()
+NOTIFIER = NotificationDispatcher(bot, JELLYFIN_URL, coalesce_seconds=CONFIG.get("notifyCoalesceSeconds", 30))
+CHECK_LIMIT = asyncio.Semaphore(max(1, int(CONFIG.get("maxConcurrentChecks", 4))))  # Due series handled at once
 
 async def command_allowed(interaction: discord.Interaction):
     if interaction.guild is None:
@@ -53,20 +60,9 @@ async def command_allowed(interaction: discord.Interaction):
     return True
 
 async def has_account(interaction: discord.Interaction):
-    conn = sqlite3.connect("hue.db")
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS jellyfin_users (
-            discord_id INTEGER PRIMARY KEY,
-            jellyfin_username TEXT NOT NULL,
-            jellyfin_password TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    cursor.execute('''
+    existing_user = await db.fetchone_async('''
         SELECT jellyfin_username FROM jellyfin_users WHERE discord_id = ?
     ''', (int(interaction.user.id),))
-    existing_user = cursor.fetchone()
     
     if existing_user:
         return True
@@ -89,18 +85,8 @@ async def create_user(interaction: discord.Interaction, username: str = None, pa
         return
 
     # Check if the user already exists
-    conn = sqlite3.connect("hue.db")
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS jellyfin_users (
-            discord_id INTEGER PRIMARY KEY,
-            jellyfin_username TEXT NOT NULL,
-            jellyfin_password TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    cursor.execute('SELECT jellyfin_username, jellyfin_password FROM jellyfin_users WHERE discord_id = ?', (int(interaction.user.id),))
-    existing_user = cursor.fetchone()
+    existing_user = await db.fetchone_async(
+        'SELECT jellyfin_username, jellyfin_password FROM jellyfin_users WHERE discord_id = ?', (int(interaction.user.id),))
     
     if existing_user:
         existing_username, existing_password = existing_user
@@ -108,152 +94,80 @@ async def create_user(interaction: discord.Interaction, username: str = None, pa
             f"You already have a Jellyfin user linked:\nUsername: {existing_username}\nPassword: {existing_password}\n",
             ephemeral=True # Very important
         )
-        conn.close()
         return True
     
     # Create a new Jellyfin user
     jellyfin_username = re.sub(r'\W+', '', username or interaction.user.name)
     jellyfin_password = password or os.urandom(4).hex()  # Generate a random password if not provided
 
+    # Jellyfin can take longer than Discord waits for a first response
+    await interaction.response.defer(ephemeral=True)
     try:
-        # Call the Jellyfin API to create a new user
-        headers = {
-            "X-Emby-Authorization": f'MediaBrowser Client="AutoBot", Device="DiscordBot", DeviceId="{interaction.user.id}", Version="1.0.0", Token="{JELLYFIN_API_KEY}"',
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "Name": jellyfin_username,
-            "Password": jellyfin_password,
-            "IsAdministrator": False,  # Set to True if you want the user to have admin rights
-            "EnableUserPreferenceAccess": True,
-            "EnablePublicSharing": False,
-            "EnableSyncTranscoding": True
-        }
-        response = requests.post(f"http://localhost:8096/Users/New", headers=headers, json=payload)
-        if response.status_code in {200, 204}:
-            # User created successfully, store in database
-            cursor.execute('''
-                INSERT INTO jellyfin_users (discord_id, jellyfin_username, jellyfin_password)
-                VALUES (?, ?, ?)
-            ''', (int(interaction.user.id), jellyfin_username, jellyfin_password))
-            conn.commit()
-            await interaction.response.send_message(
-                f"Jellyfin user created successfully:\nUsername: {jellyfin_username}\nPassword: {jellyfin_password}\n",
-                ephemeral=True
-            )
-            print(f"[+] Created Jellyfin user for {interaction.user.name} ({interaction.user.id})")
-            conn.close()
-            return True
-        else:
-            await interaction.response.send_message(
-                f"[X] Failed to create Jellyfin user: {response.text}",
-                ephemeral=True
-            )
-            print(f"[!] Failed to create Jellyfin user for {interaction.user.name} ({interaction.user.id}): {response.text}")
+        await jellyfin.client().create_user_async(jellyfin_username, jellyfin_password, interaction.user.id)
+        # User created successfully, store in database
+        await db.execute_async('''
+            INSERT INTO jellyfin_users (discord_id, jellyfin_username, jellyfin_password)
+            VALUES (?, ?, ?)
+        ''', (int(interaction.user.id), jellyfin_username, jellyfin_password))
+        await interaction.followup.send(
+            f"Jellyfin user created successfully:\nUsername: {jellyfin_username}\nPassword: {jellyfin_password}\n",
+            ephemeral=True
+        )
+        print(f"[+] Created Jellyfin user for {interaction.user.name} ({interaction.user.id})")
+        return True
+    except jellyfin.JellyfinError as e:
+        await interaction.followup.send(
+            f"[X] Failed to create Jellyfin user: {e.message}",
+            ephemeral=True
+        )
+        print(f"[!] Failed to create Jellyfin user for {interaction.user.name} ({interaction.user.id}): {e.message}")
     except Exception as e:
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"[X] An error occurred while creating the Jellyfin user: {str(e)}",
             ephemeral=True
         )
         print(f"[!] Exception during Jellyfin user creation for {interaction.user.name} ({interaction.user.id}): {e}")
-    finally:
-        conn.close()
-        return False
+    return False
              
-async def create_tables(conn, cursor=None):
-    if not cursor:
-        cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS series (
-            miruro_id TEXT PRIMARY KEY,
-            title TEXT NOT NULL,
-            season INTEGER NOT NULL,
-            episode_count INTEGER,
-            episodes_aired INTEGER,
-            next_episode_time TIMESTAMP,
-            next_episode INTEGER,
-            last_checked TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_airing BOOLEAN DEFAULT 0,
-            download_failed BOOLEAN DEFAULT 0
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS follows (
-            user_id TEXT NOT NULL,
-            miruro_id TEXT NOT NULL,
-            notify BOOLEAN DEFAULT 0,
-            PRIMARY KEY (user_id, miruro_id)
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS episodes (
-            miruro_id TEXT NOT NULL,
-            season INTEGER NOT NULL,
-            episode INTEGER NOT NULL,
-            title TEXT,
-            downloaded BOOLEAN DEFAULT 0,
-            PRIMARY KEY (miruro_id, season, episode)
-        )
-    ''')
-    conn.commit()
-
 async def add_follow(msg, interaction, series_id, notify=False, dub=False, download_all=True):
-    conn = sqlite3.connect("hue.db")
-    cursor = conn.cursor()
-    await create_tables(conn, cursor)
     user_id = interaction.user.id
-    cursor.execute('''
+    await db.execute_async('''
         INSERT OR REPLACE INTO follows (user_id, miruro_id, notify)
         VALUES (?, ?, ?)
     ''', (user_id, series_id, notify))
-    conn.commit()
 
     # Gather series info if not already done
-    cursor.execute('SELECT * FROM series WHERE miruro_id = ?', (series_id,))
-    series_info = cursor.fetchone()
-    if not series_info:
+    series_info = await db.fetchone_async('SELECT * FROM series WHERE miruro_id = ?', (series_id,))
+    if series_info:
+        await SCHEDULER.load(series_id)  # The scheduler may have dropped it while nobody followed it
+    else:
         try:
             link = f"https://www.miruro.to/watch?id={series_id}&ep=1"
-            full_cmd = ["python", "download.py", link, "--follow"] # No dub support but who cares
-            print(f"Running command: {' '.join(full_cmd)}")  # Debugging line
-            result = await asyncio.create_subprocess_exec(
-                *full_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            output = stdout.decode(errors="replace").strip() or "No output."
-            error = stderr.decode().strip()
+            print(f"[>] Gathering series info: {link}")
+            job = await ENGINE.follow(link) # No dub support but who cares
 
-            response = await parse_download_response(result, output, error)
+            response = await parse_download_response(job)
 
             if response == "<:eyebrowraised:1379311747277787207>":
                 await edit_or_send(msg, interaction, response)
-                conn.close()
                 return "no"
         except Exception as e:
             print(f"[!] Error gathering info for series ID {series_id}: {e}")
-            conn.close()
             return False
 
     if download_all:
         # Download the entire season (up to maxEpisodes)
-        cursor.execute('''
+        series_info = await db.fetchone_async('''
             SELECT miruro_id, title, season, episode_count, episodes_aired, next_episode_time, next_episode, is_airing
             FROM series WHERE miruro_id = ?
         ''', (series_id,))
-        series_info = cursor.fetchone()
         if not series_info:
             print(f"[!] Series ID {series_id} not found in database after info gathering.")
-            conn.close()
             return False
         miruro_id, title, season, episode_count, episodes_aired, next_episode_time, next_episode, is_airing = series_info
         print(f"[+] Attempting to download all of {title} Season {season} (ID: {miruro_id})")
         if episode_count is None:
             print(f"[!] Episode count for series ID {series_id} is not set. Cannot proceed with download.")
-            conn.close()
             return False
         
         episode_range = f"1-{episodes_aired + 1}" if episodes_aired < episode_count else f"1-{episode_count}"
@@ -263,47 +177,40 @@ async def add_follow(msg, interaction, series_id, notify=False, dub=False, downl
             print(f"[!] Episode count for series '{title} Season {season}' exceeds maximum episode count. "
                 f"Downloading only {CONFIG.get('maxEpisodes', 30)} most recent episodes. ")
             
-        args = f"--episodes {episode_range}"
-        if dub:
-            args += " --dub"
         try:
-            full_cmd = ["python", "download.py", f"https://www.miruro.to/watch?id={series_id}&ep=1"] + shlex.split(args)
-            print(f"Running command: {' '.join(full_cmd)}")  # Debugging line
-            result = await asyncio.create_subprocess_exec(
-                *full_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-            if result.returncode != 0:
-                print(f"[!] Download failed for series ID {series_id}: {stderr.decode().strip()}")
-                print(f"[!] Output: {stdout.decode().strip()}")
-                conn.close()
+            link = f"https://www.miruro.to/watch?id={series_id}&ep=1"
+            print(f"[>] Downloading episodes {episode_range} of {link}")
+            job = await ENGINE.submit(link, episodes=episode_range, dub=dub, kind="backfill", priority=PRIORITY_BACKFILL)
+            status = LiveStatus(msg, f"Downloading {title} Season {season} (episodes {episode_range})",
+                                started_at=interaction.created_at, edit_seconds=CONFIG.get("progressEditSeconds", 3))
+            ENGINE.watch(job, status.update)
+            try:
+                returncode = await job.task
+            finally:
+                await status.close()
+            if returncode != 0:
+                print(f"[!] Download failed for series ID {series_id} (code {returncode})")
                 return False
-            print(f"[+] Download completed for series ID {series_id}: {stdout.decode().strip()}")
-            print(f"[+] Output: {stdout.decode().strip()}")
+            print(f"[+] Download completed for series ID {series_id}")
         except Exception as e:
             print(f"[!] Exception during download for series ID {series_id}: {e}")
-            conn.close()
             return False
 
-
-    conn.close()
     return True
 
-async def parse_download_response(result, output, error):
-    if result.returncode != 0:
+async def parse_download_response(job):
+    if job.returncode != 0:
         # 1 indicates invalid episode number, 2 indicates download error, 3 cancelled server side
-        if result.returncode == 1:
+        if job.returncode == 1:
             error_msg = "[X] Invalid episode number specified."
-        elif result.returncode == 2:
+        elif job.returncode == 2:
             error_msg = "[X] Download error occurred. Please check the link and try again."
-        elif result.returncode == 3:
+        elif job.returncode == 3:
             error_msg = "[X] Download cancelled by the server."
-        elif result.returncode == 69:
+        elif job.returncode == 69:
             error_msg = "<:eyebrowraised:1379311747277787207>"
         else:
-            error_msg = f"[X] Script exited with code {result.returncode}."
+            error_msg = f"[X] Download exited with code {job.returncode}."
         response = f"{error_msg}"
         #response = f"{error_msg}\n```{error or output}```"
     else:
@@ -474,8 +381,10 @@ async def download(interaction: discord.Interaction, link: str, episodes: str =
         return
 
     # Determine whether a single episode or a range is specified
+    episode = None
+    episode_range = None
     if '-' in episodes:
-        args = f"--episodes {episodes}"
+        episode_range = episodes
         if not episodes.split('-')[0].isdigit() or not episodes.split('-')[1].isdigit():
             await interaction.followup.send(
                 "[X] Invalid episode range specified. Please use a valid range like 1-5.",
@@ -490,10 +399,14 @@ async def download(interaction: discord.Interaction, link: str, episodes: str =
             return
         num_episodes = (int(episodes.split('-')[1]) - int(episodes.split('-')[0])) + 1
     else:
-        args = f"--episode {episodes}"
+        if not episodes.isdigit():
+            await interaction.followup.send(
+                "[X] Invalid episode number specified. Please use a number like 1.",
+                ephemeral=True
+            )
+            return
+        episode = int(episodes) # 0 means use the episode in the link
         num_episodes = 1
-    if dub:
-        args += " --dub"
 
     if num_episodes > CONFIG.get("maxEpisodes", 25):
         await interaction.followup.send(
@@ -517,8 +430,6 @@ async def download(interaction: discord.Interaction, link: str, episodes: str =
     )
 
     if follow:
-        # args += " --follow"
-
         SERIES_ID = re.search(r'id=(\d+)', link)
         if SERIES_ID:
             SERIES_ID = SERIES_ID.group(1)
@@ -530,155 +441,169 @@ async def download(interaction: discord.Interaction, link: str, episodes: str =
         await add_follow(msg, interaction, SERIES_ID, notify=False, dub=dub, download_all=False)
 
     try:
-        # Run download script and capture output/errors
-        full_cmd = ["python", "download.py", link] + shlex.split(args)
-        print(f"Running command: {' '.join(full_cmd)}")  # Debugging line
-        result = await asyncio.create_subprocess_exec(
-            *full_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = await result.communicate()
+        # Run the download pipeline in-process
+        print(f"[>] Downloading {link} (episode: {episode}, episodes: {episode_range}, dub: {dub})")
+        job = await ENGINE.submit(link, episode=episode, episodes=episode_range, dub=dub, priority=PRIORITY_INTERACTIVE)
+        status = LiveStatus(msg, f"Downloading {link}", started_at=interaction.created_at,
+                            edit_seconds=CONFIG.get("progressEditSeconds", 3))
+        ENGINE.watch(job, status.update)
+        try:
+            await job.task
+        finally:
+            await status.close()
 
-        output = stdout.decode(errors="replace").strip() or "No output."
-        error = stderr.decode().strip()
-        
-        response = await parse_download_response(result, output, error)
-        print(error)
-        # print(output)
+        response = await parse_download_response(job)
         print(f"[>] Download result: {response}")
         await edit_or_send(msg, interaction, response)
     except Exception as e:
         print(f"[!] Exception during download: {e}")
         await edit_or_send(msg, interaction, f"[X] An unexpected error occurred:\n```{str(e)}```")
 
-async def schedule_episode_checks():
-    while True:
-        try:
-            await check_for_episodes()
-            print("[*] Scheduler check complete.\n")
-        except Exception as e:
-            print(f"[!] Scheduler error: {e}")
-        await asyncio.sleep((CONFIG.get('scanInterval', 10) * 60))  # wait however many minutes set in config
-
-async def notify_users(miruro_id, title, new_episode, conn, cursor):
-    cursor.execute('''
-        SELECT user_id FROM follows WHERE miruro_id = ? AND notify = 1
-    ''', (miruro_id,))
-    users = cursor.fetchall()
-    if not users:
-        print(f"[*] No users to notify for series ID {miruro_id}.")
+@bot.tree.command(name="queue", description="Show the download queue")
+async def queue(interaction: discord.Interaction):
+    if not await command_allowed(interaction):
         return
-    
-    for user in users:
-        user_id = user[0]
-        try:
-            user_obj = await bot.fetch_user(user_id)
-            if user_obj:
-                await user_obj.send(
-                    f"New episode available for **{title}**: Episode {new_episode} is now available! "
-                    f"\nCheck it out at {JELLYFIN_URL} or on the Swiftfin/Jellyfin app."
-                )
-                print(f"[+] Notified {user_obj.name} about new episode of {title}.")
-        except discord.Forbidden:
-            print(f"[!] Could not notify {user_id}: User has DMs disabled.")
-        except Exception as e:
-            print(f"[!] Error notifying {user_id}: {e}")
 
-    return
+    stats = await ENGINE.stats()
+    notes = NOTIFIER.stats()
+    await interaction.response.send_message(
+        f"Running: {stats['running']}/{stats['max_concurrent']} | Queued: {stats['queued']} | Completed: {stats['completed']}\n"
+        f"Queue wait: avg {stats['avg_wait']:.1f}s, max {stats['max_wait']:.1f}s\n"
+        f"Stored jobs: {', '.join(f'{state} {count}' for state, count in sorted(stats['stored'].items())) or 'none'}\n"
+        f"Next scheduled check: {SCHEDULER.next_due() or 'none'} | Airtime to download: {lag_summary()}\n"
+        f"Notifications: {notes['sent']} sent, {notes['failed']} failed, {notes['pending']} pending",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="stats", description="Show where download time goes")
+@app_commands.describe(days="How many days back to look (default: 7)")
+async def stats(interaction: discord.Interaction, days: int = metrics.REPORT_DAYS):
+    if not await command_allowed(interaction):
+        return
+
+    report = await db.run(metrics.report, max(1, days))
+    await interaction.response.send_message(f"```\n{report[:1900]}\n```", ephemeral=True)
+
+async def finish_episode_download(miruro_id, title, episode, returncode):
+    if returncode == 0:
+        print(f"[OK] Download successful for '{title}'")
+        await db.execute_async('''
+            UPDATE series SET download_failed = 0, last_checked = CURRENT_TIMESTAMP
+            WHERE miruro_id = ?
+        ''', (miruro_id,))
 
-async def check_for_episodes():
-    conn = sqlite3.connect("hue.db")
-    cursor = conn.cursor()
+        # Notify users who follow this series. Only queued here, the DMs go out in the background
+        NOTIFIER.notify(miruro_id, title, episode)
+    else:
+        print(f"[X] Download failed for '{title}' (code {returncode}).")
+        await db.execute_async('''
+            UPDATE series SET download_failed = 1, last_checked = CURRENT_TIMESTAMP
+            WHERE miruro_id = ?
+        ''', (miruro_id,))
+        SCHEDULER.retry_later(miruro_id)
+
+async def await_resumed_job(job):
+    # Jobs picked up from the jobs table after a restart. Nobody is waiting on the original interaction
+    # anymore, so only scheduled episode downloads need their follow-up (series flags and notifications)
+    returncode = await job.task
+    print(f"[*] Resumed {job.kind} job {job.job_id} finished with code {returncode}")
+    if job.kind != "episode":
+        return
 
-    print("[*] Checking for scheduled downloads...")
+    miruro_id = re.search(r'id=(\d+)', job.url).group(1)
+    episode = int(job.url.rsplit("&ep=", 1)[-1])
+    row = await db.fetchone_async('SELECT title FROM series WHERE miruro_id = ?', (miruro_id,))
+    title = row[0] if row else miruro_id
+    await finish_episode_download(miruro_id, title, episode, returncode)
+
+async def check_for_episodes(due_ids):
+    # Called by the scheduler with the series whose airtime has passed (or whose last download failed)
+    print(f"[*] Checking {len(due_ids)} due series...")
 
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     # Select series that are airing and have at least one follower
-    cursor.execute('''
+    series_to_download = await db.fetchall_async(f'''
         SELECT DISTINCT s.miruro_id, s.next_episode, s.title, s.season, s.next_episode_time
         FROM series s
         JOIN follows f ON s.miruro_id = f.miruro_id
         WHERE s.is_airing = 1
+          AND s.miruro_id IN ({", ".join("?" for _ in due_ids)})
           AND (
               s.download_failed = 1 OR
               (s.next_episode_time IS NOT NULL AND ? >= datetime(s.next_episode_time))
           )
-    ''', (now,))
-
-    series_to_download = cursor.fetchall()
+    ''', (*due_ids, now))
     if not series_to_download:
         print("[*] No new episodes to download.")
-        conn.close()
-        return
+        return []
+
+    # Each series runs on its own, so a slow or failing download does not hold up the others.
+    # ENGINE still decides how many downloads actually run at once
+    await asyncio.gather(*(check_series(*row) for row in series_to_download))
+    return [row[0] for row in series_to_download]
 
-    for miruro_id, next_episode, title, season, next_episode_time in series_to_download:
+async def check_series(miruro_id, next_episode, title, season, next_episode_time):
+    async with CHECK_LIMIT:
         try:
             # Check if the episode actually needs to be downloaded
-            cursor.execute('''
-                SELECT title FROM episodes WHERE miruro_id = ? AND season = ? AND episode = ?          
+            recent_episode = await db.fetchone_async('''
+                SELECT title FROM episodes WHERE miruro_id = ? AND season = ? AND episode = ?
             ''', (miruro_id, season, next_episode))
-            recent_episode = cursor.fetchone()
 
             if recent_episode:
-                cursor.execute('''
+                first_episode = await db.fetchone_async('''
                     SELECT title FROM episodes WHERE miruro_id = ? AND season = ? AND episode = ?
                 ''', (miruro_id, season, 1))
-                first_episode = cursor.fetchone()
 
                 if first_episode and first_episode == recent_episode and datetime.datetime.fromisoformat(next_episode_time) > datetime.datetime.now(): # (First episode has been downloaded) and (newly aired episode wasnt available when it failed) and (new episode shouldnt have aired yet)
                     print(f"[!] Skipping download for {title} S{season}E{next_episode}. Episode name in DB matches episode 1")
-                    continue
+                    return
+
+            # A job resumed from before a restart may already be fetching this episode
+            if ENGINE.has_job(miruro_id, kind="episode"):
+                print(f"[*] Download for '{title}' is already queued. Skipping.")
+                return
 
             print(f"[>] Attempting download for '{title} ep {next_episode}' (ID: {miruro_id})...")
 
             # Add dub flag if needed
-            command = ["python", "download.py", f"https://www.miruro.to/watch?id={miruro_id}&ep={next_episode}"]
-            if "(Dubbed)" in title:
-                command.append("--dub")
-
-            result = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+            job = await ENGINE.submit(
+                f"https://www.miruro.to/watch?id={miruro_id}&ep={next_episode}",
+                dub="(Dubbed)" in title,
+                kind="episode",
+                priority=PRIORITY_SCHEDULED
             )
-            stdout, stderr = await result.communicate()
-            output = stdout.decode(errors="replace").strip() or "No output."
-            error = stderr.decode().strip()
-
-            if result.returncode == 0:
-                print(f"[OK] Download successful for '{title}'")
-                cursor.execute('''
-                    UPDATE series SET download_failed = 0, last_checked = CURRENT_TIMESTAMP
-                    WHERE miruro_id = ?
-                ''', (miruro_id,))
-
-                # Notify users who follow this series
-                await notify_users(miruro_id, title, next_episode, conn, cursor)
-            else:
-                error = stderr.decode().strip()
-                print(f"[X] Download failed for '{title}'. Error:\n{error}")
-                cursor.execute('''
-                    UPDATE series SET download_failed = 1, last_checked = CURRENT_TIMESTAMP
-                    WHERE miruro_id = ?
-                ''', (miruro_id,))
+            returncode = await job.task
+            airtime = parse_time(next_episode_time)
+            if returncode == 0 and airtime and datetime.datetime.now() >= airtime:
+                lag = (datetime.datetime.now() - airtime).total_seconds()
+                record_lag(lag)
+                print(f"[*] '{title}' ep {next_episode} was downloaded {lag / 60:.1f} minutes after it aired.")
+            await finish_episode_download(miruro_id, title, next_episode, returncode)
 
         except Exception as e:
             print(f"[!] Exception during download for {miruro_id}: {e}")
-            cursor.execute('''
+            await db.execute_async('''
                 UPDATE series SET download_failed = 1, last_checked = CURRENT_TIMESTAMP
                 WHERE miruro_id = ?
             ''', (miruro_id,))
 
-    conn.commit()
-    conn.close()
+SCHEDULER = AirtimeScheduler(check_for_episodes, CONFIG.get('scanInterval', 10) * 60)  # scanInterval is now the retry delay
 
 @bot.event
 async def on_ready():
     await bot.tree.sync()
     print(f"Logged in as {bot.user}")
-    # Start the scheduler in the background
-    bot.loop.create_task(schedule_episode_checks())
+    # Create or migrate hue.db, then index outputDir and follow changes to it, so deleted episodes are noticed right away
+    await db.run(db.init)
+    await asyncio.to_thread(ENGINE.start_library_watcher)
+    # Pick up downloads that were queued or running when the bot last stopped
+    for job in await ENGINE.resume():
+        bot.loop.create_task(await_resumed_job(job))
+    # Start the scheduler in the background, new airtimes reach it straight from the download jobs
+    ENGINE.on_airtime = SCHEDULER.update
+    SCHEDULER.start()
+    NOTIFIER.start()
 
 bot.run(TOKEN)
@@ -0,0 +1,204 @@
+from contextlib import contextmanager
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import portalocker
+
+import hosts
+import stats_file
+
+# Path to unpacked uBlock Origin extension
+UBLOCK_PATH = os.path.abspath("./uBlock0.chromium")
+
+# Launch/reuse counters survive between runs so the savings can be compared over time
+STATS_PATH = "browser_pool.json"
+LAUNCH_LOCK = "browser_pool.lock"  # Stops two concurrent jobs from booting the same profile twice
+
+# One resident Chromium per profile. Each one listens on its own debugging port so that
+# later episodes (and later download.py runs) attach to the warm browser instead of booting a new one
+PROFILES = {
+    "miruro": {"user_data_dir": "chromium_user_data", "port": 9231},
+    "kwik": {"user_data_dir": "chromium_user_data_kwik", "port": 9232},
+}
+
+LAUNCH_TIMEOUT = 30  # Seconds to wait for a freshly launched browser to accept connections
+
+# Headless mode ("headless": true in config.json) runs without a display and without uBlock. Ads,
+# trackers and heavy resources are dropped at the Playwright route level instead, which saves
+# uBlock's start-up and keeps each tab lighter. The pipeline only reads the DOM and posts forms,
+# so nothing it needs is an image, font or video
+BLOCKLIST_PATH = "blocklist.txt"
+BLOCKED_TYPES = frozenset({"image", "font", "media"})
+
+def load_blocklist(path=BLOCKLIST_PATH):
+    if not os.path.exists(path):
+        return frozenset()
+    with open(path, "r") as file:
+        return frozenset(line.strip().lower() for line in file if line.strip() and not line.startswith("#"))
+
+BLOCKED_HOSTS = load_blocklist()
+
+def blocked_host(host):
+    # Checks the host and each parent domain, so "a.b.doubleclick.net" matches "doubleclick.net"
+    if not host:
+        return False
+    labels = host.lower().split(".")
+    return any(".".join(labels[i:]) in BLOCKED_HOSTS for i in range(len(labels) - 1))
+
+def endpoint_alive(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+class BrowserPool:
+    def __init__(self, playwright, headless=False):
+        self.playwright = playwright
+        self.headless = headless
+        self.browsers = {}
+        self.blocked = {}  # profile -> requests blocked on this connection, saved by close()
+        self.stats = stats_file.load(STATS_PATH)
+
+    def _count(self, profile, key, amount=1):
+        def change(stats):
+            counts = stats.setdefault(profile, {"launches": 0, "reuses": 0, "pages": 0})
+            counts[key] = counts.get(key, 0) + amount
+            self.stats = stats
+        stats_file.update(STATS_PATH, change, "browser pool stats")
+
+    def _launch(self, profile):
+        settings = PROFILES[profile]
+        command = [
+            self.playwright.chromium.executable_path,
+            f"--user-data-dir={os.path.abspath(settings['user_data_dir'])}",
+            f"--remote-debugging-port={settings['port']}",
+            "--no-first-run",
+            "--no-default-browser-check",
+        ]
+        if self.headless:
+            command += ["--headless=new", "--disable-extensions"]
+        else:
+            command += [f"--disable-extensions-except={UBLOCK_PATH}", f"--load-extension={UBLOCK_PATH}"]
+        # Detach the browser so it outlives this process and stays warm for the next run
+        if os.name == "nt":
+            flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+            subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=flags)
+        else:
+            subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+        deadline = time.monotonic() + LAUNCH_TIMEOUT
+        while not endpoint_alive(settings["port"]):
+            if time.monotonic() > deadline:
+                raise Exception(f"Resident browser for '{profile}' did not start within {LAUNCH_TIMEOUT} seconds.")
+            time.sleep(0.2)
+
+    def context(self, profile):
+        browser = self.browsers.get(profile)
+        if browser and browser.is_connected():
+            self._count(profile, "reuses")
+            return browser.contexts[0]
+
+        port = PROFILES[profile]["port"]
+        with open(LAUNCH_LOCK, "w") as lock_file:
+            portalocker.lock(lock_file, portalocker.LOCK_EX)
+            if endpoint_alive(port):
+                print(f"[*] Attaching to resident '{profile}' browser on port {port}...")
+                self._count(profile, "reuses")
+            else:
+                print(f"[*] Launching resident '{profile}' browser on port {port}...")
+                self._launch(profile)
+                self._count(profile, "launches")
+
+        browser = self.playwright.chromium.connect_over_cdp(f"http://127.0.0.1:{port}")
+        self.browsers[profile] = browser
+        context = browser.contexts[0]
+        if self.headless or hosts.OVERRIDES:
+            # Routes belong to this connection, so they are set up again for every attach
+            context.route("**/*", lambda route: self._filter(profile, route))
+        return context
+
+    def _filter(self, profile, route):
+        request = route.request
+        if self.headless and (request.resource_type in BLOCKED_TYPES or blocked_host(urlsplit(request.url).hostname)):
+            self.blocked[profile] = self.blocked.get(profile, 0) + 1
+            route.abort()
+            return
+        target = hosts.rewrite(request.url)
+        if target != request.url:
+            # continue_() cannot switch to the stand-in's plain http, so fetch it and hand the answer to the page
+            route.fulfill(response=route.fetch(url=target, max_redirects=0))
+        else:
+            route.continue_()
+
+    @contextmanager
+    def page(self, profile):
+        # Hand out a fresh tab in the warm context. The tab and any popups it opened are closed
+        # afterwards, the browser itself keeps running
+        context = self.context(profile)
+        page = context.new_page()
+        self._count(profile, "pages")
+        popups = []
+        page.on("popup", popups.append)
+        try:
+            yield page
+        finally:
+            for tab in popups + [page]:
+                try:
+                    tab.close()
+                except Exception:
+                    pass
+
+    def close(self):
+        # Only drops the connections, the resident browsers stay up for the next run
+        for profile, blocked in self.blocked.items():
+            self._count(profile, "blocked", blocked)
+        self.blocked = {}
+        for browser in self.browsers.values():
+            try:
+                browser.close()
+            except Exception:
+                pass
+        self.browsers = {}
+
+    def summary(self):
+        return summarize(self.stats)
+
+def summarize(stats):
+    lines = []
+    for profile in PROFILES:
+        counts = stats.get(profile, {})
+        lines.append(f"{profile}: {counts.get('launches', 0)} launches, "
+                     f"{counts.get('reuses', 0)} reuses, {counts.get('pages', 0)} pages, "
+                     f"{counts.get('blocked', 0)} requests blocked")
+    return " | ".join(lines)
+
+def shutdown():
+    from playwright.sync_api import sync_playwright
+
+    with sync_playwright() as p:
+        for profile, settings in PROFILES.items():
+            if not endpoint_alive(settings["port"]):
+                continue
+            browser = p.chromium.connect_over_cdp(f"http://127.0.0.1:{settings['port']}")
+            browser.new_browser_cdp_session().send("Browser.close")
+            print(f"[OK] Stopped resident '{profile}' browser.")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Manage the resident Chromium browsers used by download.py.")
+    parser.add_argument("--stats", action="store_true", help="Show launch and reuse counts")
+    parser.add_argument("--shutdown", action="store_true", help="Stop the resident browsers")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.shutdown:
+        shutdown()
+    if args.stats or not args.shutdown:
+        print(summarize(stats_file.load(STATS_PATH)))
+    sys.exit(0)
@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import asyncio
+import sqlite3
+import threading
+
+# Shared access to hue.db for bot.py, download.py and the helper modules. This module owns the
+# schema: init() creates every table once and applies migrations by PRAGMA user_version.
+#
+# Connections run in WAL mode with a busy timeout, so the bot can read while a download writes
+# instead of failing with "database is locked". Each thread keeps one connection (and with it
+# sqlite's prepared statement cache). The bot goes through the async helpers at the bottom, which
+# run on a small thread pool so queries never block the event loop.
+
+DB_PATH = "hue.db"
+BUSY_TIMEOUT = 30  # Seconds a writer waits for another writer before giving up
+STATEMENT_CACHE = 256
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hue-db")
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS series (
+        miruro_id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        season INTEGER NOT NULL,
+        episode_count INTEGER,
+        episodes_aired INTEGER,
+        next_episode_time TIMESTAMP,
+        next_episode INTEGER,
+        last_checked TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_airing BOOLEAN DEFAULT 0,
+        download_failed BOOLEAN DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS follows (
+        user_id TEXT NOT NULL,
+        miruro_id TEXT NOT NULL,
+        notify BOOLEAN DEFAULT 0,
+        PRIMARY KEY (user_id, miruro_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS episodes (
+        miruro_id TEXT NOT NULL,
+        season INTEGER NOT NULL,
+        episode INTEGER NOT NULL,
+        title TEXT,
+        downloaded BOOLEAN DEFAULT 0,
+        PRIMARY KEY (miruro_id, season, episode)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS jellyfin_users (
+        discord_id INTEGER PRIMARY KEY,
+        jellyfin_username TEXT NOT NULL,
+        jellyfin_password TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        miruro_id TEXT,
+        url TEXT NOT NULL,
+        episode INTEGER,
+        episodes TEXT,
+        dub BOOLEAN DEFAULT 0,
+        follow BOOLEAN DEFAULT 0,
+        state TEXT NOT NULL DEFAULT 'queued',
+        priority INTEGER DEFAULT 0,
+        attempts INTEGER DEFAULT 0,
+        last_episode INTEGER,
+        returncode INTEGER,
+        lease_expires TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority)',
+    '''
+    CREATE TABLE IF NOT EXISTS library_files (
+        path TEXT PRIMARY KEY,
+        series_title TEXT NOT NULL,
+        season INTEGER NOT NULL,
+        episode INTEGER NOT NULL,
+        size INTEGER,
+        mtime REAL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS library_files_episode ON library_files (series_title, season, episode)',
+]
+
+# Per-stage download timings, see metrics.py
+METRICS = [
+    '''
+    CREATE TABLE IF NOT EXISTS metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id INTEGER,
+        miruro_id TEXT,
+        episode INTEGER,
+        attempt INTEGER,
+        stage TEXT NOT NULL,
+        seconds REAL NOT NULL,
+        bytes INTEGER,
+        ok BOOLEAN DEFAULT 1,
+        recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS metrics_recorded ON metrics (recorded_at)',
+]
+
+# Run in order on databases whose user_version is lower than their position + 1. Version 1 is the
+# schema above, which older databases already have parts of, so it only uses IF NOT EXISTS
+MIGRATIONS = [
+    SCHEMA,
+    METRICS,
+]
+
+def _open():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+    conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, commits no longer wait for a full fsync
+    return conn
+
+def connect():
+    # The calling thread's connection. It stays open for the life of the thread, do not close it
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open()
+        _local.conn = conn
+    if not _initialized:
+        init()
+    return conn
+
+def init():
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        conn = getattr(_local, "conn", None) or _open()
+        _local.conn = conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            with conn:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+            print(f"[*] hue.db migrated to schema version {number}.")
+        _initialized = True
+
+@contextmanager
+def transaction():
+    # Commits everything inside the block at once, rolls back on error
+    conn = connect()
+    with conn:
+        yield conn
+
+def execute(query, params=()):
+    # Returns the number of changed rows
+    with transaction() as conn:
+        return conn.execute(query, params).rowcount
+
+def insert(query, params=()):
+    # Returns the rowid of the new row
+    with transaction() as conn:
+        return conn.execute(query, params).lastrowid
+
+def executemany(query, rows):
+    with transaction() as conn:
+        return conn.executemany(query, rows).rowcount
+
+def fetchone(query, params=()):
+    return connect().execute(query, params).fetchone()
+
+def fetchall(query, params=()):
+    return connect().execute(query, params).fetchall()
+
+# Async versions for the bot. They run the same functions on the db thread pool
+
+async def run(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, function, *args)
+
+async def execute_async(query, params=()):
+    return await run(execute, query, params)
+
+async def insert_async(query, params=()):
+    return await run(insert, query, params)
+
+async def executemany_async(query, rows):
+    return await run(executemany, query, rows)
+
+async def fetchone_async(query, params=()):
+    return await run(fetchone, query, params)
+
+async def fetchall_async(query, params=()):
+    return await run(fetchall, query, params)
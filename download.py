@@ -1,4 +1,6 @@
 from playwright.sync_api import sync_playwright, TimeoutError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import requests
@@ -8,12 +10,22 @@ import argparse
 import os
 import re
 import sys
-import sqlite3
+import threading
 import portalocker
 import xml.etree.ElementTree as ET
 import warnings
 import unicodedata
 
+from browser_pool import BrowserPool
+from library import LibraryIndex
+import artwork
+import db
+import hosts
+import jellyfin
+import metadata
+import metrics
+import transfer
+
 warnings.filterwarnings("ignore", message="The default datetime adapter is deprecated*", category=DeprecationWarning)
 
 # TODO: Add support for other streaming servers with download links if they are added to the site
@@ -24,70 +36,183 @@ warnings.filterwarnings("ignore", message="The default datetime adapter is depre
 # TODO: Fix episodes getting overwritten for Part 2 of a season. (Either combine them into one episode or keep them separate)
 # TODO: Notify user which episodes failed to download and which succeeded
 # TODO: Find a way to ensure the 1080p version is downloaded
-# TODO: Move away from using global variables. Create objects that are passed to each function
-# TODO: Make it so that if the episode exists but not the nfo, it will attempt to create just the nfo file
 # TODO: Add "airs before" and "airs after" tags for seasons and/or episodes
 
 # TODO: Fix .nfo utf-8 encoding not supporting a middle dot
 
-# Load jellyfin API key from .env file
+# Load the Jellyfin API key and address from .env file (used by jellyfin.py)
 load_dotenv()
-JELLYFIN_API_KEY = os.getenv("JELLYFIN_API_KEY")
-
-# Path to unpacked uBlock Origin extension
-UBLOCK_PATH = os.path.abspath("./uBlock0.chromium")
 
 # Output directory for downloaded video
 OUTPUT_DIR = os.path.abspath("./output") # Default if not set in config
-OUTPUT_NAME = "episode.mp4"
-SERIES_TITLE = "Unknown Series"
-SERIES_ID = None
-SEASON_NUMBER = 1
-EPISODE_NUMBER = 0
-EPISODE_NAME = "Unknown Episode"
-FOLLOW = False  # Whether to follow the series and download new episodes as they release
 MAX_RETRIES = 3
 MAX_EPISODES = 25  # Maximum episodes to download in one run
-DUB = False  # Default to subbed unless specified
-EPISODES_IN_SEASON = 0 # Number of episodes in the selected season for range validation
-EPISODES_AIRED = 0
-AIRING = False
 CONFIG_PATH = "config.json"
 config = {}
-conn = None
-cursor = None
-LOCK_FILE = "download.lock"
-
-def acquire_download_lock():
-    lock_file = open(LOCK_FILE, "w")
-    print("[*] Waiting to acquire download lock...")
-    portalocker.lock(lock_file, portalocker.LOCK_EX)  # Will block here until lock is free
+LOCK_DIR = "locks"  # One lock file per series, so unrelated series download in parallel
+LIBRARY = None  # LibraryIndex of OUTPUT_DIR, created by load_settings()
+
+# Deadline in milliseconds for each page stage. Every stage finishes as soon as its selector or
+# event fires, so these only matter when a page is broken. Override per stage with "stageDeadlines" in config.json
+STAGE_DEADLINES = {
+    "miruro_ready": 30000,
+    "miruro_episode": 10000,
+    "miruro_sources": 15000,
+    "mal_link": 5000,
+    "airing_info": 5000,
+    "server_list": 15000,
+    "kiwi_selected": 10000,
+    "download_button": 15000,
+    "pahe_redirect": 30000,
+    "kwik_ready": 20000,
+    "kwik_popup": 5000,
+    "kwik_form": 15000,
+}
+# The current episode's control. open_episode marks the previous episode's as stale before an in-place move
+DOWNLOAD_BUTTON = 'button[title="Download Episode"]:not([data-stale-episode])'
+CANCEL_CHECK_MS = 1000  # Waits are split into slices this long so cancelled jobs stop promptly
+
+class DownloadError(Exception):
+    # Codes match the exit codes of the CLI: 1 invalid episode number, 2 download error, 3 cancelled, 69 blacklisted series
+    def __init__(self, code, message=""):
+        super().__init__(message)
+        self.code = code
+
+class DownloadJob:
+    # Everything one run of the pipeline needs, passed to each function instead of module globals
+    def __init__(self, url, episode=None, episodes=None, dub=False, follow=False, debug=False):
+        self.url = url
+        self.episode = episode
+        self.episodes = episodes
+        self.dub = dub  # Default to subbed unless specified
+        self.follow = follow  # Whether to follow the series and download new episodes as they release
+        self.debug = debug
+
+        self.series_id = None
+        self.series_title = "Unknown Series"
+        self.season_number = 1
+        self.episode_number = 0
+        self.episode_name = "Unknown Episode"
+        self.output_name = "episode.mp4"
+        self.episodes_in_season = 0 # Number of episodes in the selected season for range validation
+        self.episodes_aired = 0
+        self.airing = False
+
+        self.conn = None
+        self.cursor = None
+        self.pool = None  # Resident browsers shared by every episode in this job
+        self.pages = None  # ExitStack holding the miruro tab that stays open for the whole range
+        self.miruro_page = None
+        self.miruro_url = None  # Episode the miruro tab is showing
+        self.in_place = True  # False once the page did not follow an in-place episode change
+        self.series_read = False  # Title, season, counts, tags and airtime were read from the page
+        self.kwik_href = None  # Last resolved kwik link, an in-place move must not hand out the same one again
+        self.returncode = None
+        self.task = None  # Set by the engine when the job is scheduled
+        self.queued_at = None
+        self.job_id = None  # Row in the jobs table, None for manual runs
+        self.kind = None
+        self.priority = 0
+        self.on_episode_done = None  # Called from the worker thread with each finished episode number
+        self.on_airtime = None  # Called from the worker thread with (series_id, next airtime or None) after it is saved
+        self.on_progress = None  # Called from the worker thread with each progress event, see emit()
+        self.metrics = None  # metrics.EpisodeMetrics of the episode being downloaded
+        self.episode_range = None  # (first, last) once run_job has resolved it
+        self.series_nfo_written = False
+        self.synced_episodes = set()  # Episodes whose NFO and row were written by sync_metadata
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise DownloadError(3, "Download cancelled.")
+
+def stage_deadline(stage):
+    return config.get("stageDeadlines", {}).get(stage, STAGE_DEADLINES[stage])
+
+def record_wait(job, stage, seconds, ok=True):
+    # Saved with the episode's metrics (see metrics.py), the report shows them next to the deadlines
+    if job.metrics:
+        job.metrics.wait(stage, seconds, ok)
+
+def emit(job, event, **fields):
+    # Structured progress for whoever is watching the job: the bot's live status message or the
+    # JSON lines of --progress-json. Events: episode_started, stage, transfer, episode_done, retry
+    if not job.on_progress:
+        return
+    fields.update({"event": event, "job": job.job_id, "series": job.series_id, "episode": job.episode_number,
+                   "time": round(time.time(), 3)})
+    try:
+        job.on_progress(fields)
+    except Exception as e:
+        print(f"[!] Progress listener failed: {e}")
+
+def emit_transfer(job, stats):
+    emit(job, "transfer", bytes=stats.resumed_from + stats.bytes, size=stats.expected, rate=round(stats.rate))
+
+def wait_until(job, stage, wait):
+    # Runs a Playwright wait (called with a timeout in ms) until it succeeds or the stage deadline passes
+    emit(job, "stage", stage=stage)
+    start = time.monotonic()
+    deadline = start + stage_deadline(stage) / 1000
+    while True:
+        job.check_cancelled()
+        remaining = (deadline - time.monotonic()) * 1000
+        if remaining <= 0:
+            record_wait(job, stage, time.monotonic() - start, ok=False)
+            raise TimeoutError(f"Stage '{stage}' did not finish within {stage_deadline(stage)} ms.")
+        try:
+            result = wait(min(remaining, CANCEL_CHECK_MS))
+        except TimeoutError:
+            continue
+        record_wait(job, stage, time.monotonic() - start)
+        return result
+
+def series_id_from_url(url):
+    match = re.search(r'id=(\d+)', url)
+    return match.group(1) if match else None
+
+def acquire_series_lock(series_id):
+    # Works across threads of the bot and across manual download.py runs
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    lock_file = open(os.path.join(LOCK_DIR, f"series_{series_id}.lock"), "w")
+    print(f"[*] Waiting to acquire lock for series ID {series_id}...")
+    portalocker.lock(lock_file, portalocker.LOCK_EX)  # Will block here until no other job works on this series
     print("[OK] Lock acquired.")
     return lock_file
 
-def get_kwik_download_page(miruro_url):
-    global SERIES_TITLE, SEASON_NUMBER
+def get_kwik_download_page(job, miruro_url):
+    cursor = job.cursor
     # Before opening the browser, check if the episode has already been downloaded
     cursor.execute('''
         SELECT downloaded FROM episodes
         WHERE miruro_id = ? AND episode = ? AND downloaded = 1
-    ''', (SERIES_ID, EPISODE_NUMBER))
+    ''', (job.series_id, job.episode_number))
     row = cursor.fetchone()
 
     # If episode exists in the database and is indicated as downloaded, check if the file really exists
     if row and row[0]:
         cursor.execute('''
             SELECT title, season FROM series WHERE miruro_id = ?
-        ''', (SERIES_ID,))
+        ''', (job.series_id,))
         series_row = cursor.fetchone()
         if series_row:
-            SERIES_TITLE, SEASON_NUMBER = series_row
-        OUTPUT_NAME = os.path.join(OUTPUT_DIR, SERIES_TITLE, f"Season {SEASON_NUMBER:02}", f"{SERIES_TITLE} S{SEASON_NUMBER:02}E{EPISODE_NUMBER:02}.mp4")
-
-        print(f"[*] Checking if filename {OUTPUT_NAME} exists...")
-        if os.path.exists(OUTPUT_NAME): # Need to query DB for series name etc.
-            print(f"[!] Episode {EPISODE_NUMBER} of ID:{SERIES_ID} is already downloaded.")
-            # Check if .nfo exists for this episode and create one if it doesn't
+            job.series_title, job.season_number = series_row
+
+        print(f"[*] Looking up {job.series_title} S{job.season_number:02}E{job.episode_number:02} in the library index...")
+        if LIBRARY.lookup(job.series_title, job.season_number, job.episode_number):
+            print(f"[!] Episode {job.episode_number} of ID:{job.series_id} is already downloaded.")
+            nfo_path = os.path.join(OUTPUT_DIR, episode_output_name(
+                job.series_title, job.season_number, job.episode_number))[:-len(".mp4")] + ".nfo"
+            if series_row and not os.path.exists(nfo_path):
+                print("[*] Its .nfo is missing, writing it from the cached metadata...")
+                repair_series(job.series_title, job.season_number, {"episodes": [job.episode_number], "artwork": False})
             return "skip"
         print("[*] Database indicates episode is downloaded, but file does not exist. ")
 
@@ -96,28 +221,38 @@ def get_kwik_download_page(miruro_url):
             UPDATE episodes
             SET downloaded = 0
             WHERE miruro_id = ? AND episode = ?
-        ''', (SERIES_ID, EPISODE_NUMBER))
-        conn.commit()
+        ''', (job.series_id, job.episode_number))
+        job.conn.commit()
 
+    # A transfer that died part way can be finished from the recorded file URL without opening the browser
+    cursor.execute('''
+        SELECT title, season FROM series WHERE miruro_id = ?
+    ''', (job.series_id,))
+    series_row = cursor.fetchone()
+    if series_row and not job.follow:
+        title, season = series_row
+        output_name = episode_output_name(title, season, job.episode_number)
+        job.metrics.mark("resume")
+        stats = transfer.resume_direct(os.path.join(OUTPUT_DIR, output_name), cancelled=lambda: job.cancelled,
+                                       segments=config.get("downloadSegments", 4),
+                                       progress=lambda stats: emit_transfer(job, stats))
+        if not stats:
+            job.metrics.discard()  # Nothing to resume
+        else:
+            job.metrics.done(stats.bytes)
+            job.series_title, job.season_number, job.output_name = title, season, output_name
+            print(f"[OK] Finished the partial download of episode {job.episode_number} ({stats.summary()})")
+            mark_downloaded(job)
+            return "skip"
 
-    with sync_playwright() as p:
-        user_data_dir = os.path.abspath("chromium_user_data")
-        browser = p.chromium.launch_persistent_context(
-            user_data_dir=user_data_dir,
-            headless=False,
-            args=[
-                f'--disable-extensions-except={UBLOCK_PATH}',
-                f'--load-extension={UBLOCK_PATH}',
-            ]
-        )
-
-        page = browser.pages[0] if browser.pages else browser.new_page()
-
-        print("[*] Opening miruro.to page...")
-        page.goto(miruro_url)
-        page.wait_for_timeout(5000)  # wait for JavaScript content
+    job.check_cancelled()
+    job.metrics.mark("miruro_browser")
+    page = miruro_page(job)
+    job.metrics.mark("miruro_page")
+    moved = open_episode(job, page, miruro_url)
 
-        # Get episodes_aired before gather_episode_info()
+    # Get episodes_aired before gather_episode_info(). The counts do not change within a range
+    if not job.series_read:
         info_blocks = page.query_selector_all("div.t4mg1tz p")
         episodes = None
         for block in info_blocks:
@@ -129,122 +264,190 @@ def get_kwik_download_page(miruro_url):
                     break
         print(f"[+] {episodes} episodes found in the series info block.")
         if episodes:
-            EPISODES_AIRED = int(episodes.group(1).replace(',', ''))
-            EPISODES_IN_SEASON = int(episodes.group(2).replace(',', '')) if episodes.group(2) else EPISODES_AIRED + 2 # Default to aired + 2 if not specified
+            job.episodes_aired = int(episodes.group(1).replace(',', ''))
+            job.episodes_in_season = int(episodes.group(2).replace(',', '')) if episodes.group(2) else job.episodes_aired + 2 # Default to aired + 2 if not specified
 
-        # Check if the requested episode number matches the page
-        match = re.search(r'&ep=(\d+)', miruro_url)
-        if match:
-            requested_episode = int(match.group(1))
+    # Check if the requested episode number matches the page
+    match = re.search(r'&ep=(\d+)', miruro_url)
+    if match:
+        requested_episode = int(match.group(1))
+    else:
+        print("[X] Error: Could not determine episode number from URL. "
+                "Please specify with --episode or --episodes.")
+        raise DownloadError(1, "Could not determine episode number from URL.")
+    if requested_episode not in range(1, job.episodes_aired + 2):  # +2 because the aired count is sometimes off by 1
+        if requested_episode not in range(1, job.episodes_in_season + 1):
+            print(f"[X] Error: Episode {requested_episode} is not valid for this season. "
+                f"Only episodes 1 to {job.episodes_in_season} are available in this season.")
+            raise DownloadError(1, f"Episode {requested_episode} is not valid for this season.") # 1 for invalid episode number
         else:
-            print("[X] Error: Could not determine episode number from URL. "
-                    "Please specify with --episode or --episodes.")
-            conn.close()
-            sys.exit(1)
-        if requested_episode not in range(1, EPISODES_AIRED + 2):  # +2 because the aired count is sometimes off by 1
-            if requested_episode not in range(1, EPISODES_IN_SEASON + 1):
-                print(f"[X] Error: Episode {requested_episode} is not valid for this season. "
-                    f"Only episodes 1 to {EPISODES_IN_SEASON} are available in this season.")
-                conn.close()
-                sys.exit(1) # 1 for invalid episode number
-            else:
-                print(f"[X] Error: Episode {requested_episode} has not aired yet. "
-                    f"Only episodes 1 to {EPISODES_AIRED + 1 if EPISODES_AIRED + 1 <= EPISODES_IN_SEASON else EPISODES_AIRED} have aired.")
-                conn.close()
-                sys.exit(1)
-
-        # Check if the page is on the correct episode
-        ep_number_element = page.query_selector(".title-container .ep-number")
-        if not ep_number_element:
-            raise ValueError("Could not find episode number on page.")
-        match = re.search(r'\d+', ep_number_element.inner_text().strip())
-        ep_number_element = int(match.group(0))
-        if ep_number_element != requested_episode:
-            raise ValueError(f"Current episode ({ep_number_element}) does not match requested episode ({requested_episode}). "
-                             "Please check the URL or specify the episode with --episode or --episodes.")
-
-        # Now that the page has been confirmed to be correct, gather basic info about the episode/series
-        gather_episode_info(page, browser)
-
-        # Create the appropriate directories if they dont exist
-        os.makedirs(os.path.join(OUTPUT_DIR, SERIES_TITLE, f"Season {int(SEASON_NUMBER):02}"), exist_ok=True)
-
-        # Now write .nfo files to ensure jellyfin has reliable metadata
-        parse_metadata(page, browser, SERIES_ID, SERIES_TITLE)
-
-        if FOLLOW:
-            print("[*] Following the series. No download will be performed.") # Bot script should next attempt to download the whole season
-            browser.close()
-            return "skip"
+            print(f"[X] Error: Episode {requested_episode} has not aired yet. "
+                f"Only episodes 1 to {job.episodes_aired + 1 if job.episodes_aired + 1 <= job.episodes_in_season else job.episodes_aired} have aired.")
+            raise DownloadError(1, f"Episode {requested_episode} has not aired yet.")
+
+    # Check if the page is on the correct episode
+    ep_number_element = page.query_selector(".title-container .ep-number")
+    if not ep_number_element:
+        raise ValueError("Could not find episode number on page.")
+    match = re.search(r'\d+', ep_number_element.inner_text().strip())
+    ep_number_element = int(match.group(0))
+    if ep_number_element != requested_episode:
+        raise ValueError(f"Current episode ({ep_number_element}) does not match requested episode ({requested_episode}). "
+                         "Please check the URL or specify the episode with --episode or --episodes.")
+
+    # Now that the page has been confirmed to be correct, gather basic info about the episode/series.
+    # Later episodes of a range only need the episode's own title
+    if job.series_read:
+        gather_episode_title(job, page)
+    else:
+        gather_episode_info(job, page)
+        job.series_read = True
+
+    # Create the appropriate directories if they dont exist
+    os.makedirs(os.path.join(OUTPUT_DIR, job.series_title, f"Season {job.season_number:02}"), exist_ok=True)
+
+    # Now write .nfo files to ensure jellyfin has reliable metadata
+    job.metrics.mark("metadata")
+    parse_metadata(job, page)
+
+    if job.follow:
+        print("[*] Following the series. No download will be performed.") # Bot script should next attempt to download the whole season
+        return "skip"
+
+    job.check_cancelled()
 
-        # Check if the correct playback server is selected
+    # Check if the correct playback server is selected. After an in-place episode change the page
+    # normally still has it, which one evaluate confirms without waiting on the server list
+    job.metrics.mark("server_select")
+    if moved and kiwi_still_selected(job, page):
+        print("[*] Kiwi server is still selected.")
+    else:
         print("[*] Checking if playback server is Kiwi...")
-        ensure_kiwi_server_selected(page)
+        ensure_kiwi_server_selected(job, page)
         print("[OK] Kiwi server is selected under Sub section.")
 
-        print("[*] Waiting for 'Download Episode' button...")
-        try:
-            page.wait_for_selector('button[title="Download Episode"]', timeout=15000)
-            page.click('button[title="Download Episode"]')
-            print("[+] Clicked the Download Episode button.")
-        except TimeoutError:
-            raise Exception("Could not find or click the Download Episode button")
-
+    job.metrics.mark("pahe_redirect")
+    href = find_kwik_href(job, page)
+    if moved and href == job.kwik_href:
+        # The click still opened the previous episode's sources, a full load cannot race like that
+        print("[!] The download link is still the previous episode's, loading the page instead.")
+        job.in_place = False
+        open_episode(job, page, miruro_url)
+        ensure_kiwi_server_selected(job, page)
+        href = find_kwik_href(job, page)
+    job.kwik_href = href
+    job.metrics.done()
+    return href
+
+def find_kwik_href(job, page):
+    # Clicks Download Episode and reads the kwik.si link from the pahe.win tab it opens
+    print("[*] Waiting for 'Download Episode' button...")
+    try:
+        wait_until(job, "download_button", lambda timeout: page.wait_for_selector(DOWNLOAD_BUTTON, timeout=timeout))
+    except TimeoutError:
+        raise Exception("Could not find or click the Download Episode button")
+
+    # The pahe.win tab is a popup of this page, so concurrent tabs in the shared browser are never picked up by mistake
+    with page.expect_popup(timeout=stage_deadline("download_button")) as popup_info:
+        page.click(DOWNLOAD_BUTTON)
+        print("[+] Clicked the Download Episode button.")
         print("[*] Waiting for new tab to open...")
-        new_page = browser.wait_for_event("page", timeout=15000)
-        new_page.wait_for_load_state()
-        print("[+] Switched to new tab (likely pahe.win).")
-
-        print("[*] Polling for 'a.redirect' link...")
-        for i in range(30):
-            element = new_page.query_selector("a.redirect")
-            if element:
-                href = element.get_attribute("href")
-                text = element.inner_text()
-                print(f"[{i+1:02}s] Text: '{text}' | Href: {href}")
-                if href and href.startswith("https://kwik.si/f/"):
-                    print(f"[OK] Found kwik.si URL: {href}")
-                    browser.close()
-                    return href
-            else:
-                print(f"[{i+1:02}s] 'a.redirect' not yet found.")
-            new_page.wait_for_timeout(1000)
+    new_page = popup_info.value
+    new_page.wait_for_load_state()
+    print("[+] Switched to new tab (likely pahe.win).")
 
-        browser.close()
+    print("[*] Waiting for 'a.redirect' link...")
+    try:
+        element = wait_until(job, "pahe_redirect", lambda timeout: new_page.wait_for_selector(
+            "a.redirect[href^='https://kwik.si/f/']", state="attached", timeout=timeout))
+    except TimeoutError:
         raise Exception("Timed out waiting for redirect button.")
-
-def gather_episode_info(page, browser):
-    global SERIES_TITLE, EPISODE_NAME, SEASON_NUMBER, EPISODE_NUMBER, OUTPUT_NAME, EPISODES_IN_SEASON, EPISODES_AIRED, AIRING
-    SERIES_TITLE = page.query_selector("div.title.anime-title a").inner_text()
-    if DUB:
-        SERIES_TITLE += " (Dubbed)"
+    href = element.get_attribute("href")
+    print(f"[OK] Found kwik.si URL: {href}")
+    try:
+        new_page.close()  # The miruro tab stays open for the next episode, its pahe.win tabs do not need to
+    except Exception:
+        pass
+    return href
+
+def episode_output_name(title, season, episode):
+    return os.path.join(title, f"Season {season:02}", f"{title} S{season:02}E{episode:02}.mp4")
+
+def miruro_page(job):
+    # One miruro tab per job, later episodes of a range reuse it instead of loading the site again
+    if job.miruro_page is None:
+        job.miruro_page = job.pages.enter_context(job.pool.page("miruro"))
+        job.miruro_url = None
+    return job.miruro_page
+
+def drop_miruro_page(job):
+    # After a failed attempt the tab may be anywhere, the retry starts from a fresh one
+    if job.miruro_page is not None:
+        job.pages.close()
+        job.pages = ExitStack()
+        job.miruro_page = None
+        job.miruro_url = None
+
+def open_episode(job, page, miruro_url):
+    # Returns True if the loaded page was moved to the episode in place. The SPA's router follows
+    # pushState + popstate, which skips loading and starting the whole site again. Falls back to a
+    # full load when the page does not follow, and stops trying for the rest of the job
+    if job.miruro_url and job.in_place:
+        print("[*] Moving the miruro.to page to the next episode...")
+        # The old episode's download control is marked first, so the click waits for the one the
+        # new episode renders once its sources have loaded
+        page.evaluate('''url => {
+            document.querySelectorAll('button[title="Download Episode"]').forEach(button => button.dataset.staleEpisode = "1");
+            history.pushState(history.state, "", url);
+            window.dispatchEvent(new PopStateEvent("popstate", {state: history.state}));
+        }''', miruro_url)
+        try:
+            wait_until(job, "miruro_episode", lambda timeout: page.wait_for_function('''episode => {
+                const number = document.querySelector(".title-container .ep-number");
+                return number && (number.innerText.match(/\\d+/) || [])[0] == episode
+                    && document.querySelector(".title-container .ep-title");
+            }''', arg=job.episode_number, timeout=timeout))
+            wait_until(job, "miruro_sources", lambda timeout: page.wait_for_selector(
+                DOWNLOAD_BUTTON, state="attached", timeout=timeout))
+            job.miruro_url = miruro_url
+            return True
+        except TimeoutError:
+            print("[!] The page did not follow the episode change, loading it instead.")
+            job.in_place = False
+
+    print("[*] Opening miruro.to page...")
+    page.goto(miruro_url)
+    # Wait for the JavaScript content the rest of this function reads
+    wait_until(job, "miruro_ready", lambda timeout: page.wait_for_function('''
+        () => document.querySelector(".title-container .ep-number")
+            && document.querySelector(".title-container .ep-title")
+            && document.querySelector("div.title.anime-title a")
+            && document.querySelector("div.t4mg1tz p")
+    ''', timeout=timeout))
+    job.miruro_url = miruro_url
+    return False
+
+def kiwi_still_selected(job, page):
+    target_label = "dub" if job.dub else "sub"
+    return page.evaluate('''label => [...document.querySelectorAll("div.r1s34uq0 > div")].some(group => {
+        const name = group.querySelector("div");
+        return name && name.innerText.toLowerCase().includes(label)
+            && [...group.querySelectorAll("button.b1nm6r8.active")].some(button => button.innerText.toLowerCase().includes("kiwi"));
+    })''', target_label)
+
+def gather_episode_info(job, page):
+    cursor = job.cursor
+    job.series_title = page.query_selector("div.title.anime-title a").inner_text()
+    if job.dub:
+        job.series_title += " (Dubbed)"
 
     if config.get("banNSFW", True):
         tags_div = page.query_selector("div.t4mg1tz > div[style*='flex-wrap']")
-        blacklist = {"ECCHI", "HENTAI"}
-        whitelist_titles = {
-            "nogamenolife",
-            "konosuba", 
-            "mushokutensei", 
-            "killlakill", 
-            "mydress-updarling", 
-            "weneverlearn"
-        }
-        normalized_title = SERIES_TITLE.lower().replace(" ", "")
-        is_whitelisted = any(kw in normalized_title for kw in whitelist_titles)
-
-        if tags_div and not is_whitelisted:
+        if tags_div:
             tag_elements = tags_div.query_selector_all("a")
-            tags = {tag.inner_text().strip().upper() for tag in tag_elements}
-            print(f"[*] Tags found: {tags}")
+            check_banned_tags(job, {tag.inner_text().strip().upper() for tag in tag_elements})
 
-            if blacklist & tags:
-                print("[X] Blacklisted tag detected. Skipping this series.")
-                browser.close()
-                conn.close()
-                sys.exit(69)
-
-    if not EPISODES_IN_SEASON:
+    if not job.episodes_in_season:
         info_blocks = page.query_selector_all("div.t4mg1tz p")
         episodes = None
         for block in info_blocks:
@@ -256,43 +459,34 @@ def gather_episode_info(page, browser):
                     break
         print(f"[+] {episodes} episodes found in the series info block.")
         if episodes:
-            EPISODES_AIRED = int(episodes.group(1).replace(',', ''))
-            EPISODES_IN_SEASON = int(episodes.group(2).replace(',', '')) if episodes.group(2) else EPISODES_AIRED + 2 # Default to aired + 2 if not specified
-
-    EPISODE_NAME = page.query_selector(".title-container .ep-title").inner_text()
+            job.episodes_aired = int(episodes.group(1).replace(',', ''))
+            job.episodes_in_season = int(episodes.group(2).replace(',', '')) if episodes.group(2) else job.episodes_aired + 2 # Default to aired + 2 if not specified
 
-    match = re.match(r'^(.*?)(?:\s+(Season\s+\d+))?(?:\s+Part\s*\d+|\s+Cour\s*\d+)?$', SERIES_TITLE, re.IGNORECASE)
-    if match:
-        series = match.group(1).strip()
-        season = match.group(2).strip().replace("Season ", "") if match.group(2) else None
-        SERIES_TITLE = series
-        SEASON_NUMBER = int(season) if season else 1
+    job.episode_name = page.query_selector(".title-container .ep-title").inner_text()
 
-    SEASON_NUMBER = f"{SEASON_NUMBER:02}"
-    EPISODE_NUMBER = f"{EPISODE_NUMBER:02}"
- 
-    # Remove characters not allowed in Windows directory names
-    SERIES_TITLE = re.sub(r'[<>:"/\\|?*]', '', SERIES_TITLE)
-    OUTPUT_NAME = os.path.join(SERIES_TITLE, f"Season {SEASON_NUMBER}", f"{SERIES_TITLE} S{SEASON_NUMBER}E{EPISODE_NUMBER}.mp4")
+    split_series_title(job)
 
-    print(f"[+] Series: {SERIES_TITLE} | Season: {SEASON_NUMBER} | Episode: {EPISODE_NAME}")
+    print(f"[+] Series: {job.series_title} | Season: {job.season_number:02} | Episode: {job.episode_name}")
 
     # Determine if the series is currently airing
-    AIRING = False  # Default
+    job.airing = False  # Default
 
     status_elements = page.query_selector_all("div.t4mg1tz p")
     for element in status_elements:
         text = element.inner_text().strip().lower()
         if text.startswith("status:"):
-            AIRING = "airing" in text
+            job.airing = "airing" in text
             break
 
     # find airing day and time
     NEXT_EPISODE_TIMESTAMP = None
     NEXT_EPISODE_NUMBER = None
 
-    if AIRING:
-        airing_div = page.query_selector("div.eb48q8z > p")
+    if job.airing:
+        try:
+            airing_div = wait_until(job, "airing_info", lambda timeout: page.wait_for_selector("div.eb48q8z > p", state="attached", timeout=timeout))
+        except TimeoutError:
+            airing_div = None
         if airing_div:
             airing_text = airing_div.inner_text().strip()
             print(f"[*] Found airing info: {airing_text}")
@@ -316,7 +510,7 @@ def gather_episode_info(page, browser):
             print("[!] Airing info div not found")
     else:
         print("[*] Series is not currently airing. Setting next episode to None.")
-        EPISODES_IN_SEASON = EPISODES_AIRED  # If not airing, assume all episodes have aired
+        job.episodes_in_season = job.episodes_aired  # If not airing, assume all episodes have aired
         NEXT_EPISODE_TIMESTAMP = None
         NEXT_EPISODE_NUMBER = None
 
@@ -324,64 +518,184 @@ def gather_episode_info(page, browser):
     cursor.execute('''
             INSERT OR REPLACE INTO episodes (miruro_id, season, episode, title, downloaded)
             VALUES (?, ?, ?, ?, 0)
-        ''', (SERIES_ID, int(SEASON_NUMBER), int(EPISODE_NUMBER), EPISODE_NAME))
-    cursor.execute('''
+        ''', (job.series_id, job.season_number, job.episode_number, job.episode_name))
+    save_series_info(job, NEXT_EPISODE_TIMESTAMP, NEXT_EPISODE_NUMBER)
+
+def gather_episode_title(job, page):
+    # Series title, season, tags and airtime were read with the first episode of the range
+    job.episode_name = page.query_selector(".title-container .ep-title").inner_text()
+    job.output_name = episode_output_name(job.series_title, job.season_number, job.episode_number)
+    print(f"[+] Series: {job.series_title} | Season: {job.season_number:02} | Episode: {job.episode_name}")
+    job.cursor.execute('''
+        INSERT OR REPLACE INTO episodes (miruro_id, season, episode, title, downloaded)
+        VALUES (?, ?, ?, ?, 0)
+    ''', (job.series_id, job.season_number, job.episode_number, job.episode_name))
+    job.conn.commit()
+
+def check_banned_tags(job, tags):
+    # tags are upper case genre names, from the page or from the AniList info
+    blacklist = {"ECCHI", "HENTAI"}
+    whitelist_titles = {
+        "nogamenolife",
+        "konosuba",
+        "mushokutensei",
+        "killlakill",
+        "mydress-updarling",
+        "weneverlearn"
+    }
+    normalized_title = job.series_title.lower().replace(" ", "")
+    if any(kw in normalized_title for kw in whitelist_titles):
+        return
+    print(f"[*] Tags found: {tags}")
+    if blacklist & tags:
+        print("[X] Blacklisted tag detected. Skipping this series.")
+        raise DownloadError(69, "Blacklisted tag detected.")
+
+def split_series_title(job):
+    # "Title Season 2 Part 2" -> series title "Title", season 2
+    match = re.match(r'^(.*?)(?:\s+(Season\s+\d+))?(?:\s+Part\s*\d+|\s+Cour\s*\d+)?$', job.series_title, re.IGNORECASE)
+    if match:
+        series = match.group(1).strip()
+        season = match.group(2).strip().replace("Season ", "") if match.group(2) else None
+        job.series_title = series
+        job.season_number = int(season) if season else 1
+
+    # Remove characters not allowed in Windows directory names
+    job.series_title = re.sub(r'[<>:"/\\|?*]', '', job.series_title)
+    job.output_name = episode_output_name(job.series_title, job.season_number, job.episode_number)
+
+def save_series_info(job, next_episode_time, next_episode):
+    job.cursor.execute('''
         INSERT OR REPLACE INTO series (miruro_id, title, season, episode_count, episodes_aired, next_episode_time, next_episode, is_airing, last_checked)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (SERIES_ID, SERIES_TITLE, int(SEASON_NUMBER), EPISODES_IN_SEASON, EPISODES_AIRED, NEXT_EPISODE_TIMESTAMP, NEXT_EPISODE_NUMBER, AIRING))
-    conn.commit()
+    ''', (job.series_id, job.series_title, job.season_number, job.episodes_in_season, job.episodes_aired, next_episode_time, next_episode, job.airing))
+    job.conn.commit()
+    if job.on_airtime:
+        job.on_airtime(job.series_id, next_episode_time if job.airing else None)
+
+def gather_series_info(job):
+    # Browserless version of the series half of gather_episode_info, used for --follow. Everything
+    # comes from the cached AniList info. Raises metadata.MetadataError or ValueError when the API
+    # does not have what the page would show, the caller then falls back to the page
+    info = metadata.anilist_info(job.series_id, True, config)
+    titles = info.get("title") or {}
+    title = titles.get("english") or titles.get("romaji") or titles.get("userPreferred")
+    status = info.get("status")
+    if not title or status not in ("RELEASING", "FINISHED", "CANCELLED"):
+        raise ValueError(f"AniList info has no usable title or status ({status})")
+
+    job.series_title = title + (" (Dubbed)" if job.dub else "")
+    if config.get("banNSFW", True):
+        tags = {genre.upper() for genre in info.get("genres") or []}
+        if info.get("isAdult"):
+            tags.add("HENTAI")
+        check_banned_tags(job, tags)
+    split_series_title(job)
+
+    job.airing = status == "RELEASING"
+    total = info.get("episodes")
+    next_episode_time = next_episode = None
+    if job.airing:
+        next_airing = info.get("nextAiringEpisode") or {}
+        if not next_airing.get("episode") or not next_airing.get("airingAt"):
+            raise ValueError("AniList info has no next airing episode")
+        next_episode = int(next_airing["episode"])
+        next_episode_time = datetime.fromtimestamp(int(next_airing["airingAt"]))
+        job.episodes_aired = next_episode - 1
+        job.episodes_in_season = total or job.episodes_aired + 2  # Same default as the page when the total is unknown
+    else:
+        if not total:
+            raise ValueError("AniList info has no episode count")
+        job.episodes_aired = job.episodes_in_season = total
+
+    print(f"[+] Series: {job.series_title} | Season: {job.season_number:02} | "
+          f"Aired: {job.episodes_aired}/{job.episodes_in_season} | Next: {next_episode} at {next_episode_time}")
+    save_series_info(job, next_episode_time, next_episode)
+
+def follow_from_api(job):
+    # The series row is all a follow needs, so the browser is only started if the API falls short.
+    # Returns False in that case. Only writes the series row, so the bot runs it without the series lock
+    job.series_id = job.series_id or series_id_from_url(job.url)
+    if job.conn is None:
+        job.conn = db.connect()
+        job.cursor = job.conn.cursor()
+    try:
+        gather_series_info(job)
+    except (metadata.MetadataError, ValueError, TypeError) as e:
+        print(f"[!] Could not get the series info from the API, reading it from the page instead: {e}")
+        return False
+    print("[*] Following the series. No download will be performed.")
+    return True
 
 def download_image(url, dest_path):
-    if not url:
-        print(f"[!] No URL provided for image: {dest_path}")
-        return
-    try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        with open(dest_path, "wb") as f:
-            f.write(response.content)
-        print(f"[OK] Downloaded image to {dest_path}")
-    except Exception as e:
-        print(f"[X] Failed to download image {url}: {e}")
+    # Unchanged images are skipped or revalidated instead of downloaded again (see artwork.py)
+    return artwork.fetch_image(url, dest_path)
+
+def parse_metadata(job, page):
+    if job.episode_number in job.synced_episodes:
+        print(f"[*] Metadata for episode {job.episode_number} was already written for this range.")
+        return True
 
-def parse_metadata(page, browser, miruro_id, SERIES_TITLE):
     # Find the href for the MAL link
-    href = page.get_attribute("a[href^='https://myanimelist.net/anime/']", "href")
+    try:
+        link = wait_until(job, "mal_link", lambda timeout: page.wait_for_selector(
+            "a[href^='https://myanimelist.net/anime/']", state="attached", timeout=timeout))
+        href = link.get_attribute("href")
+    except TimeoutError:
+        href = None
 
     # Extract the MAL ID from the href
+    mal_id = None
     if href:
         mal_id = href.rstrip("/").split("/")[-1]
         print(f"[+] Found MAL ID: {mal_id}")
     else:
         print("[X] MAL ID not found.")
 
-    anilist_json_link = f"https://www.miruro.to/api/info/anilist/{miruro_id}"
-    mal_json_link = f"https://www.miruro.to/api/episodes?malId={mal_id}&ongoing={str(AIRING).lower()}"
-
-    print(f"[*] Anilist JSON link: {anilist_json_link}")
-    print(f"[*] MAL JSON link: {mal_json_link}")
-
+    # Both documents are cached per series (see metadata.py), so only the first episode of a range fetches them
     try:
-        info_res = requests.get(anilist_json_link)
-        episodes_res = requests.get(mal_json_link)
-
-        if info_res.status_code != 200:
-            print(f"[!] Failed to fetch AniList metadata: {info_res.status_code}")
+        try:
+            anilist_json = metadata.anilist_info(job.series_id, job.airing, config)
+        except metadata.MetadataError as e:
+            print(f"[!] Failed to fetch AniList metadata: {e}")
             return False
 
-        if episodes_res.status_code != 200:
-            print(f"[!] Failed to fetch episode list: {episodes_res.status_code}")
+        try:
+            # The AniList info carries the MAL ID too when the page had no MAL link
+            mal_json = metadata.mal_episodes(mal_id or anilist_json.get("idMal"), job.airing, config)
+        except metadata.MetadataError as e:
+            print(f"[!] Failed to fetch episode list: {e}")
             return False
 
-        create_nfo(info_res.json(), episodes_res.json())
+        sync_metadata(job, anilist_json, mal_json)
 
     except Exception as e:
         print(f"[X] Error fetching metadata: {e}")
 
-def create_nfo(anilist_json, mal_json):
-    write_series_nfo(anilist_json, mal_json, SERIES_TITLE)
-    write_episode_nfo(anilist_json, mal_json, SERIES_TITLE)
-    return
+def sync_metadata(job, anilist_json, mal_json):
+    # One pass over the episode list for the whole requested range: the series/season NFO once, every
+    # episode NFO, and all episode rows in one transaction. Later episodes of the range skip parse_metadata
+    if not job.series_nfo_written:
+        write_series_nfo(job, anilist_json, mal_json)
+        job.series_nfo_written = True
+
+    first, last = job.episode_range or (job.episode_number, job.episode_number)
+    rows = []
+    for episode_number in range(first, last + 1):
+        episode_obj = write_episode_nfo(job, anilist_json, mal_json, episode_number)
+        if not episode_obj:
+            continue
+        job.synced_episodes.add(episode_number)
+        rows.append((job.series_id, job.season_number, episode_number, episode_obj.get("title") or None))
+
+    # Keeps the downloaded flag of existing rows, the page title written by gather_episode_info wins
+    with job.conn:
+        job.conn.executemany('''
+            INSERT INTO episodes (miruro_id, season, episode, title, downloaded)
+            VALUES (?, ?, ?, ?, 0)
+            ON CONFLICT (miruro_id, season, episode) DO UPDATE SET title = COALESCE(episodes.title, excluded.title)
+        ''', rows)
+    print(f"[+] Wrote metadata for {len(rows)} of {last - first + 1} episodes ({first}-{last}).")
 
 def safe_unicode(text):
     if text is None:
@@ -390,7 +704,7 @@ def safe_unicode(text):
         text = str(text)
     return unicodedata.normalize("NFC", text)
 
-def write_series_nfo(anilist_json, mal_json, SERIES_TITLE): # info, episodes (respectively)
+def write_series_nfo(job, anilist_json, mal_json): # info, episodes (respectively)
     if anilist_json.get("coverImage", {}).get("extraLarge"):
         poster = anilist_json.get("coverImage", {}).get("extraLarge", "")
     else:
@@ -399,22 +713,22 @@ def write_series_nfo(anilist_json, mal_json, SERIES_TITLE): # info, episodes (re
     TMDB_id, TMDB_obj = next(iter(mal_json.get("TMDB", "").items()))
     TMDB_id = int(TMDB_id)
     backdrop_url = TMDB_obj.get("metadata", {}).get("tvShowDetails", {}).get("show", {}).get("backdrop_path", "")
-    backdrop_url = f"https://image.tmdb.org/t/p/original{backdrop_url}"
+    backdrop_url = artwork.tmdb_url(backdrop_url, config.get("tmdbImageSize", artwork.TMDB_SIZE))
 
-    if int(SEASON_NUMBER) > 1: # Specific season. Write nfo as season specific
+    if job.season_number > 1: # Specific season. Write nfo as season specific
         season = ET.Element("season")
 
         ET.SubElement(season, "title").text = safe_unicode(anilist_json.get("title", {}).get("english", ""))
-        ET.SubElement(season, "seasonnumber").text = safe_unicode(str(int(SEASON_NUMBER)))
+        ET.SubElement(season, "seasonnumber").text = safe_unicode(str(job.season_number))
         ET.SubElement(season, "year").text = safe_unicode(str(anilist_json.get("startDate", {}).get("year", "")))
         ET.SubElement(season, "plot").text = safe_unicode(anilist_json.get("description", ""))
         ET.SubElement(season, "rating").text = safe_unicode(str(anilist_json.get("averageScore", "")))
         ET.SubElement(season, "thumb", {"aspect": "poster"}).text = safe_unicode(poster)
         # ET.SubElement(season, "thumb", {"aspect": "banner"}).text = safe_unicode(anilist_json.get("bannerImage", ""))
         tree = ET.ElementTree(season)
-        path = os.path.join(OUTPUT_DIR, SERIES_TITLE, f"Season {SEASON_NUMBER}", "season.nfo")
-        backdrop_path = os.path.join(OUTPUT_DIR, SERIES_TITLE, f"Season {SEASON_NUMBER}", f"backdrop.jpg")
-        banner_path = os.path.join(OUTPUT_DIR, SERIES_TITLE, f"Season {SEASON_NUMBER}", f"banner.jpg")
+        path = os.path.join(OUTPUT_DIR, job.series_title, f"Season {job.season_number:02}", "season.nfo")
+        backdrop_path = os.path.join(OUTPUT_DIR, job.series_title, f"Season {job.season_number:02}", f"backdrop.jpg")
+        banner_path = os.path.join(OUTPUT_DIR, job.series_title, f"Season {job.season_number:02}", f"banner.jpg")
 
     else: # No season indicator, defaulting to show overview
         tvshow = ET.Element("tvshow")
@@ -426,16 +740,19 @@ def write_series_nfo(anilist_json, mal_json, SERIES_TITLE): # info, episodes (re
         ET.SubElement(tvshow, "thumb", {"aspect": "poster"}).text = safe_unicode(poster)
         # ET.SubElement(tvshow, "thumb", {"aspect": "banner"}).text = safe_unicode(anilist_json.get("bannerImage", ""))
         tree = ET.ElementTree(tvshow)
-        path = os.path.join(OUTPUT_DIR, SERIES_TITLE, "tvshow.nfo")
-        backdrop_path = os.path.join(OUTPUT_DIR, SERIES_TITLE, "backdrop.jpg")
-        banner_path = os.path.join(OUTPUT_DIR, SERIES_TITLE, "banner.jpg")
+        path = os.path.join(OUTPUT_DIR, job.series_title, "tvshow.nfo")
+        backdrop_path = os.path.join(OUTPUT_DIR, job.series_title, "backdrop.jpg")
+        banner_path = os.path.join(OUTPUT_DIR, job.series_title, "banner.jpg")
 
     download_image(backdrop_url, backdrop_path)
     download_image(anilist_json.get("bannerImage", ""), banner_path)
 
     tree.write(path, encoding="utf-8", xml_declaration=True)
 
-def write_episode_nfo(anilist_json, mal_json, SERIES_TITLE):
+def write_episode_nfo(job, anilist_json, mal_json, episode_number=None):
+    # Returns the episode's metadata entry, or False if the episode list has no entry for it
+    if episode_number is None:
+        episode_number = job.episode_number
     try:
         TMDB_id, TMDB_obj = next(iter(mal_json.get("TMDB", "").items()))
         TMDB_id = int(TMDB_id)
@@ -447,14 +764,14 @@ def write_episode_nfo(anilist_json, mal_json, SERIES_TITLE):
         if mal_first_episode_number <= 0: # This only occurs if mal_last_episode_number ends up being 0
             mal_first_episode_number = 1
 
-        mal_episode_number = mal_first_episode_number + int(EPISODE_NUMBER) - 1
+        mal_episode_number = mal_first_episode_number + episode_number - 1
 
         episode_obj = None
         for ep in shows_arr:
             if ep.get("number", "") == mal_episode_number:
                 episode_obj = ep
                 break
-        
+
         if episode_obj is None:
             print(f"[!] Episode {mal_episode_number} not found in metadata")
             return False
@@ -462,23 +779,25 @@ def write_episode_nfo(anilist_json, mal_json, SERIES_TITLE):
     except Exception as e:
         print(f"[!] Couldn't find the key within TMDB: {e}")
         return False
-    
-    nfo_path = os.path.join(OUTPUT_DIR, SERIES_TITLE, f"Season {SEASON_NUMBER:02}", f"{SERIES_TITLE} S{SEASON_NUMBER:02}E{EPISODE_NUMBER:02}.nfo")
-    episode_xml = ET.Element("episodedetails") 
+
+    nfo_path = os.path.join(OUTPUT_DIR, job.series_title, f"Season {job.season_number:02}", f"{job.series_title} S{job.season_number:02}E{episode_number:02}.nfo")
+    episode_xml = ET.Element("episodedetails")
     ET.SubElement(episode_xml, "title").text = safe_unicode(episode_obj.get("title", ""))
-    ET.SubElement(episode_xml, "season").text = safe_unicode(str(int(SEASON_NUMBER)))
-    ET.SubElement(episode_xml, "episode").text = safe_unicode(str(int(EPISODE_NUMBER)))
+    ET.SubElement(episode_xml, "season").text = safe_unicode(str(job.season_number))
+    ET.SubElement(episode_xml, "episode").text = safe_unicode(str(episode_number))
     ET.SubElement(episode_xml, "aired").text = safe_unicode(episode_obj.get("airDate", ""))
     ET.SubElement(episode_xml, "plot").text = safe_unicode(episode_obj.get("description", ""))
     ET.SubElement(episode_xml, "thumb", {"aspect": "poster"}).text = safe_unicode(episode_obj.get("image", ""))
 
     tree = ET.ElementTree(episode_xml)
     tree.write(nfo_path, encoding="utf-8", xml_declaration=True)
+    return episode_obj
 
-def ensure_kiwi_server_selected(page):
-    target_label = "dub" if DUB else "sub"
+def ensure_kiwi_server_selected(job, page):
+    target_label = "dub" if job.dub else "sub"
     print(f"[*] Looking for 'kiwi' server under {target_label.capitalize()} section...")
 
+    wait_until(job, "server_list", lambda timeout: page.wait_for_selector("div.r1s34uq0 button.b1nm6r8", timeout=timeout))
     server_groups = page.query_selector_all("div.r1s34uq0 > div")
 
     for group in server_groups:
@@ -497,7 +816,8 @@ def ensure_kiwi_server_selected(page):
                         else:
                             print(f"[>] Selecting 'kiwi' server under {target_label.capitalize()}...")
                             btn.click()
-                            page.wait_for_timeout(1500)
+                            wait_until(job, "kiwi_selected", lambda timeout: page.wait_for_function(
+                                "button => button.classList.contains('active')", arg=btn, timeout=timeout))
                         return
                 raise Exception(f"Could not find 'kiwi' button in {target_label.capitalize()} section.")
         except Exception as e:
@@ -505,29 +825,21 @@ def ensure_kiwi_server_selected(page):
 
     raise Exception(f"{target_label.capitalize()} section with 'kiwi' server not found.")
 
-def get_kwik_download_link(kwik_f_url):
-    from playwright.sync_api import sync_playwright
-    import os
-
+def get_kwik_download_link(job, kwik_f_url):
     if kwik_f_url == "skip":
         return
 
+    job.check_cancelled()
     print("[*] Opening kwik.si page with Playwright...")
 
-    with sync_playwright() as p:
-        user_data_dir = os.path.abspath("chromium_user_data_kwik")
-        browser = p.chromium.launch_persistent_context(
-            user_data_dir=user_data_dir,
-            headless=False,
-            args=[
-                f'--disable-extensions-except={UBLOCK_PATH}',
-                f'--load-extension={UBLOCK_PATH}',
-            ]
-        )
-
-        page = browser.pages[0] if browser.pages else browser.new_page()
+    job.metrics.mark("kwik_browser")
+    with job.pool.page("kwik") as page:
+        job.metrics.mark("kwik_form")  # Page load, popup, bot check and form
         page.goto(kwik_f_url)
-        page.wait_for_timeout(3000)
+        # Either an overlay, the bot check or the form itself shows up first
+        wait_until(job, "kwik_ready", lambda timeout: page.wait_for_selector(
+            "#vidmate-popup .close-popup, button.btn.btn-primary.btn-captcha, form[action^='https://kwik.si/d/']",
+            state="attached", timeout=timeout))
 
         # Optional: Save HTML snapshot for debugging
         # html_snapshot_path = os.path.join(OUTPUT_DIR, "kwik_page_debug.html")
@@ -540,7 +852,7 @@ def get_kwik_download_link(kwik_f_url):
             if page.query_selector("#vidmate-popup .close-popup"):
                 print("[*] Found popup overlay. Closing it...")
                 page.click("#vidmate-popup .close-popup")
-                page.wait_for_timeout(2000)
+                wait_until(job, "kwik_popup", lambda timeout: page.wait_for_selector("#vidmate-popup", state="hidden", timeout=timeout))
                 print("[+] Closed popup overlay.")
         except Exception as e:
             print("[!] No popup or error closing popup:", e)
@@ -550,24 +862,18 @@ def get_kwik_download_link(kwik_f_url):
             if page.query_selector("button.btn.btn-primary.btn-captcha"):
                 print("[*] Found human verification button. Clicking it...")
                 page.click("button.btn.btn-primary.btn-captcha")
-                page.wait_for_timeout(4000)
                 print("[+] Clicked verification button.")
         except Exception as e:
             print("[!] No bot check button or error:", e)
 
-        # Step 3: Poll for the download form
+        # Step 3: Wait for the download form
         print("[*] Waiting for download form to appear...")
-        form_found = False
-        for i in range(15):
-            if page.query_selector("form[action^='https://kwik.si/d/']"):
-                print("[OK] Found download form.")
-                form_found = True
-                break
-            print(f"[{i+1}s] Still waiting...")
-            time.sleep(1)
-
-        if not form_found:
+        try:
+            wait_until(job, "kwik_form", lambda timeout: page.wait_for_selector(
+                "form[action^='https://kwik.si/d/']", state="attached", timeout=timeout))
+        except TimeoutError:
             raise Exception("Download form never appeared after verification/popup step.")
+        print("[OK] Found download form.")
 
         # Step 4: Extract action and token
         form_action = page.get_attribute("form[action^='https://kwik.si/d/']", "action")
@@ -576,109 +882,160 @@ def get_kwik_download_link(kwik_f_url):
         print(f"[+] Extracted form action: {form_action}")
         print(f"[+] Extracted _token: {token}")
 
-        # Step 5: Submit form inside browser session to capture download
-        print("[*] Submitting form via Playwright to get the real file...")
+        # Step 5: Post the form with the browser's cookies and stream the file straight to the output path
+        print("[*] Submitting form and streaming the file...")
 
         for attempt in range(MAX_RETRIES):
+            job.check_cancelled()
             try:
                 print(f"[*] Form submission attempt {attempt+1}/{MAX_RETRIES}")
 
-                with page.expect_download(timeout=10000) as download_info:
-                    page.evaluate(f'''
-                        () => {{
-                            const form = document.createElement('form');
-                            form.method = 'POST';
-                            form.action = '{form_action}';
-                            const tokenInput = document.createElement('input');
-                            tokenInput.type = 'hidden';
-                            tokenInput.name = '_token';
-                            tokenInput.value = '{token}';
-                            form.appendChild(tokenInput);
-                            document.body.appendChild(form);
-                            form.submit();
-                        }}
-                    ''')
-                    download = download_info.value
-
-                # Save the downloaded file
+                session = transfer.session_from_page(page, kwik_f_url)
                 os.makedirs(OUTPUT_DIR, exist_ok=True)
-                output_path = os.path.join(OUTPUT_DIR, OUTPUT_NAME)
-                download.save_as(output_path)
-
-                print(f"[OK] Download complete: {output_path}")
-                browser.close()
+                output_path = os.path.join(OUTPUT_DIR, job.output_name)
+                job.metrics.mark("transfer")
+                stats = transfer.download_to_file(session, "POST", form_action, output_path,
+                                                  data={"_token": token}, cancelled=lambda: job.cancelled,
+                                                  segments=config.get("downloadSegments", 4),
+                                                  progress=lambda stats: emit_transfer(job, stats))
+
+                job.metrics.done(stats.bytes)
+                print(f"[OK] Download complete: {output_path} ({stats.summary()})")
                 break
 
             except Exception as e:
+                job.check_cancelled()
                 print(f"[!] Form submission attempt {attempt + 1} failed: {e}")
+                job.metrics.fail()
                 if attempt < MAX_RETRIES - 1:
                     print("[*] Refreshing kwik.si page to retry...")
+                    job.metrics.mark("kwik_form")
                     page.reload()
-                    page.wait_for_timeout(3000)
+                    try:
+                        wait_until(job, "kwik_form", lambda timeout: page.wait_for_selector(
+                            "form[action^='https://kwik.si/d/']", state="attached", timeout=timeout))
+                    except TimeoutError:
+                        print("[!] Download form did not come back after the refresh.")
+                    # The token changes with every page load
+                    token = page.get_attribute("input[name='_token']", "value") or token
                 else:
                     print("[X] Max download page refreshes reached. Exiting.")
-                    browser.close()
                     raise
 
         airing = 1  # Default to airing
-        if int(EPISODES_AIRED) == int(EPISODES_IN_SEASON) or int(EPISODE_NUMBER) == int(EPISODES_IN_SEASON):
+        if job.episodes_aired == job.episodes_in_season or job.episode_number == job.episodes_in_season:
             print("[*] This is the last episode of the season. Marking as not airing in the database.")
             airing = 0
 
-        cursor.execute('''
-            UPDATE episodes
-            SET downloaded = 1
-            WHERE miruro_id = ? AND season = ? AND episode = ?
-        ''', (SERIES_ID, SEASON_NUMBER, EPISODE_NUMBER))
-        cursor.execute('''
-            UPDATE series
-            SET last_checked = CURRENT_TIMESTAMP,
-                download_failed = 0,
-                is_airing = ?
-            WHERE miruro_id = ?
-        ''', (airing, SERIES_ID))
-        conn.commit()
-
-def create_tables():
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS series (
-            miruro_id TEXT PRIMARY KEY,
-            title TEXT NOT NULL,
-            season INTEGER NOT NULL,
-            episode_count INTEGER,
-            episodes_aired INTEGER,
-            next_episode_time TIMESTAMP,
-            next_episode INTEGER,
-            last_checked TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_airing BOOLEAN DEFAULT 0,
-            download_failed BOOLEAN DEFAULT 0
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS follows (
-            user_id TEXT NOT NULL,
-            miruro_id TEXT NOT NULL,
-            notify BOOLEAN DEFAULT 0,
-            PRIMARY KEY (user_id, miruro_id)
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS episodes (
-            miruro_id TEXT NOT NULL,
-            season INTEGER NOT NULL,
-            episode INTEGER NOT NULL,
-            title TEXT,
-            downloaded BOOLEAN DEFAULT 0,
-            PRIMARY KEY (miruro_id, season, episode)
-        )
-    ''')
+        mark_downloaded(job, airing)
+
+def mark_downloaded(job, airing=None):
+    # airing is None when the episode was finished without reading the page, is_airing stays as it was
+    job.cursor.execute('''
+        UPDATE episodes
+        SET downloaded = 1
+        WHERE miruro_id = ? AND season = ? AND episode = ?
+    ''', (job.series_id, job.season_number, job.episode_number))
+    job.cursor.execute('''
+        UPDATE series
+        SET last_checked = CURRENT_TIMESTAMP,
+            download_failed = 0,
+            is_airing = COALESCE(?, is_airing)
+        WHERE miruro_id = ?
+    ''', (airing, job.series_id))
+    job.conn.commit()
+    jellyfin.REFRESH.add(os.path.join(OUTPUT_DIR, job.output_name))
+
+def find_library_gaps():
+    # Walks OUTPUT_DIR and returns {(series title, season): {"episodes": [...], "artwork": bool}} for
+    # every season that has videos without an .nfo or is missing its series/season NFO or artwork
+    gaps = {}
+    if not os.path.isdir(OUTPUT_DIR):
+        return gaps
+    for series_title in sorted(os.listdir(OUTPUT_DIR)):
+        series_dir = os.path.join(OUTPUT_DIR, series_title)
+        if not os.path.isdir(series_dir):
+            continue
+        for season_dir_name in sorted(os.listdir(series_dir)):
+            match = re.match(r'^Season (\d+)$', season_dir_name)
+            season_dir = os.path.join(series_dir, season_dir_name)
+            if not match or not os.path.isdir(season_dir):
+                continue
+            season = int(match.group(1))
+
+            missing = []
+            for name in os.listdir(season_dir):
+                episode = re.search(r' S\d+E(\d+)\.mp4$', name)
+                if episode and not os.path.exists(os.path.join(season_dir, name[:-len(".mp4")] + ".nfo")):
+                    missing.append(int(episode.group(1)))
+
+            art_dir = season_dir if season > 1 else series_dir
+            art_files = ["season.nfo" if season > 1 else "tvshow.nfo", "backdrop.jpg", "banner.jpg"]
+            artwork_missing = not all(os.path.exists(os.path.join(art_dir, name)) for name in art_files)
+
+            if missing or artwork_missing:
+                gaps[(series_title, season)] = {"episodes": sorted(missing), "artwork": artwork_missing}
+    return gaps
+
+def repair_series(series_title, season, gap):
+    # Fills one season in from the cached JSON APIs and its series row, without a browser
+    row = db.fetchone('''
+        SELECT miruro_id, is_airing FROM series WHERE title = ? AND season = ?
+    ''', (series_title, season))
+    if not row:
+        print(f"[!] {series_title} Season {season:02} has no series row in hue.db. Skipping.")
+        return 0
+
+    job = DownloadJob(f"https://www.miruro.to/watch?id={row[0]}")
+    job.series_id, job.airing = row[0], bool(row[1])
+    job.series_title, job.season_number = series_title, season
+
+    try:
+        anilist_json = metadata.anilist_info(job.series_id, job.airing, config)
+        mal_id = anilist_json.get("idMal")
+        if not mal_id:
+            print(f"[!] No MAL ID for {series_title} (ID: {job.series_id}). Skipping.")
+            return 0
+        mal_json = metadata.mal_episodes(mal_id, job.airing, config)
+    except metadata.MetadataError as e:
+        print(f"[!] Could not fetch metadata for {series_title}: {e}")
+        return 0
+
+    written = 0
+    if gap["artwork"]:
+        try:
+            write_series_nfo(job, anilist_json, mal_json)
+            written += 1
+        except Exception as e:
+            print(f"[!] Could not write series NFO for {series_title}: {e}")
+    for episode in gap["episodes"]:
+        if write_episode_nfo(job, anilist_json, mal_json, episode):
+            written += 1
+    if written:
+        jellyfin.REFRESH.add(os.path.join(OUTPUT_DIR, series_title, f"Season {season:02}"))
+    print(f"[OK] Repaired {series_title} Season {season:02}: {written} file(s) written.")
+    return written
+
+def repair_library():
+    gaps = find_library_gaps()
+    if not gaps:
+        print(f"[OK] Nothing to repair in {OUTPUT_DIR}.")
+        return 0
+    print(f"[*] Repairing {len(gaps)} season(s) in {OUTPUT_DIR}...")
+    workers = max(1, int(config.get("repairWorkers", 8)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(repair_series, title, season, gap) for (title, season), gap in gaps.items()]
+        written = sum(future.result() for future in futures)
+    print(f"[OK] Repair finished: {written} file(s) written. Metadata cache: {metadata.summary()}")
+    jellyfin.REFRESH.flush()
+    return written
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Download a miruro.to episode through pahe.win ➜ kwik.si "
                     "using Playwright (Chromium + uBlock Origin)."
     )
-    parser.add_argument("url", help="Full miruro episode URL")
+    parser.add_argument("url", nargs="?", help="Full miruro episode URL")
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -704,8 +1061,28 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Follow the series and download new episodes as they release"
     )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help="Rebuild the library index from outputDir and sync the downloaded flags in hue.db"
+    )
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="Write missing NFOs and artwork for videos already in outputDir without opening a browser"
+    )
+    parser.add_argument(
+        "--progress-json",
+        metavar="PATH",
+        help="Write progress events as JSON lines to PATH ('-' for stdout, the logs then go to stderr)"
+    )
+    parser.add_argument(
+        "--refresh-jellyfin",
+        action="store_true",
+        help="Ask Jellyfin to rescan the whole library (downloads normally only refresh the files they wrote)"
+    )
     args = parser.parse_args()
-    if not args.url:
+    if not args.url and not args.repair and not args.scan and not args.refresh_jellyfin:
         parser.error("The url argument is required. Please provide a valid miruro.to episode link.")
 
     return args
@@ -716,117 +1093,177 @@ def load_config(path=CONFIG_PATH):
     with open(path, "r") as file:
         return json.load(file)
 
+def load_settings():
+    global config, OUTPUT_DIR, MAX_EPISODES, LIBRARY
+    config = load_config()
+    MAX_EPISODES = config.get("maxEpisodes", MAX_EPISODES)
+    OUTPUT_DIR = os.path.abspath(config.get("outputDir", OUTPUT_DIR))
+    LIBRARY = LibraryIndex(OUTPUT_DIR)
+    if config.get("jellyfinOutputDir"):
+        jellyfin.REFRESH.path_map = (OUTPUT_DIR, config["jellyfinOutputDir"])
+    hosts.configure(config.get("hostOverrides"))
+
 def trigger_jellyfin_scan():
-    url = "http://localhost:8096/Library/Refresh"
-    headers = {
-        "X-Emby-Token": JELLYFIN_API_KEY
-    }
-    response = requests.post(url, headers=headers)
-    if response.status_code == 204:
+    try:
+        jellyfin.client().refresh_library()
         print("[OK] Jellyfin library scan initiated.")
+    except jellyfin.JellyfinError as e:
+        print(f"[X] Failed to start Jellyfin scan. Status: {e.status}")
+    except requests.RequestException as e:
+        print(f"[X] Failed to start Jellyfin scan: {e}")
+
+def resolve_episode_range(job):
+    if job.episode:
+        return (job.episode, job.episode)
+    if job.episodes and '-' in job.episodes:
+        episode_range = job.episodes.split('-')
+        if len(episode_range) != 2 or not all(x.isdigit() for x in episode_range):
+            raise DownloadError(1, "Invalid episode range format. Use 'start-end' (e.g. 1-5).")
+        episode_range = (int(episode_range[0]), int(episode_range[1]))
+        if episode_range[0] <= 0 or episode_range[1] <= 0:
+            raise DownloadError(1, "Episode numbers must be positive integers.")
+        if episode_range[0] > episode_range[1]:
+            raise DownloadError(1, "Start episode must be less than or equal to end episode.")
+        if episode_range[1] - episode_range[0] + 1 > MAX_EPISODES:
+            raise DownloadError(1, f"Cannot download more than {MAX_EPISODES} episodes at once.")
+        return episode_range
+    # Ensure the URL contains &ep=NUM at the end
+    if job.url.rsplit("&ep=", 1)[-1].isdigit():
+        episode = int(re.sub("[^0-9]", "", job.url[-4:]))
+        if episode <= 0:
+            raise DownloadError(1, "Could not determine episode number from URL. "
+                                "Please specify with --episode or --episodes.")
+        return (episode, episode)
+    raise DownloadError(1, "No episode number found in URL. "
+                        "Please specify with --episode or --episodes.")
+
+def run_job(job):
+    # Runs the whole pipeline for one job. Raises DownloadError with the matching exit code on failure
+    episode_range = resolve_episode_range(job)
+    job.episode_range = episode_range
+
+    job.series_id = series_id_from_url(job.url)
+    if job.series_id:
+        print(f"[*] Series ID: {job.series_id}")
     else:
-        print(f"[X] Failed to start Jellyfin scan. Status: {response.status_code}")
+        print("[!] Could not determine series ID from URL. "
+            "Please ensure the URL is correct and contains a valid series ID.")
+        raise DownloadError(1, "Could not determine series ID from URL.")
 
-def main() -> None:
-    lock_file = acquire_download_lock()
+    lock_file = acquire_series_lock(job.series_id)
+    jellyfin.REFRESH.begin()  # Files from this job reach Jellyfin in one refresh once it is over
     try:
-        global config, OUTPUT_DIR, EPISODE_NUMBER, MAX_EPISODES, DUB, FOLLOW, SERIES_ID, conn, cursor
-        config = load_config()
-        MAX_EPISODES = config.get("maxEpisodes", MAX_EPISODES)
-
-        conn = sqlite3.connect("hue.db")
-        cursor = conn.cursor()
-        create_tables()
-
-        args = parse_args()
-        Miruro_URL = args.url    
-        DUB = args.dub
-        
-        OUTPUT_DIR = os.path.abspath(config.get("outputDir", OUTPUT_DIR))
-
-        if args.episode:
-            EPISODE_NUMBER = args.episode
-            EPISODE_RANGE = (EPISODE_NUMBER, EPISODE_NUMBER)
-        elif args.episodes and '-' in args.episodes:
-            EPISODE_RANGE = args.episodes.split('-')
-            if len(EPISODE_RANGE) != 2 or not all(x.isdigit() for x in EPISODE_RANGE):
-                raise ValueError("Invalid episode range format. Use 'start-end' (e.g. 1-5).")
-            EPISODE_RANGE = (int(EPISODE_RANGE[0]), int(EPISODE_RANGE[1]))
-            if EPISODE_RANGE[0] <= 0 or EPISODE_RANGE[1] <= 0:
-                raise ValueError("Episode numbers must be positive integers.")
-            if EPISODE_RANGE[0] > EPISODE_RANGE[1]:
-                raise ValueError("Start episode must be less than or equal to end episode.")
-            if EPISODE_RANGE[1] - EPISODE_RANGE[0] + 1 > MAX_EPISODES:
-                raise ValueError(f"Cannot download more than {MAX_EPISODES} episodes at once.")
-        else:
-            # Ensure the URL contains &ep=NUM at the end
-            if Miruro_URL.rsplit("&ep=", 1)[-1].isdigit():
-                EPISODE_NUMBER = int(re.sub("[^0-9]", "", args.url[-4:]))
-                if EPISODE_NUMBER <= 0:
-                    raise ValueError("Could not determine episode number from URL. "
-                                    "Please specify with --episode or --episodes.")
-                EPISODE_RANGE = (EPISODE_NUMBER, EPISODE_NUMBER)
-            else:
-                raise ValueError("No episode number found in URL. "
-                                "Please specify with --episode or --episodes.")
-        
-        SERIES_ID = re.search(r'id=(\d+)', Miruro_URL)
-        if SERIES_ID:
-            SERIES_ID = SERIES_ID.group(1)
-            print(f"[*] Series ID: {SERIES_ID}")
-        else:
-            print("[!] Could not determine series ID from URL. "
-                "Please ensure the URL is correct and contains a valid series ID.")
-            conn.close()
-            sys.exit(1)
+        job.conn = db.connect()
+        job.cursor = job.conn.cursor()
 
-        if args.follow:
-            FOLLOW = True
+        if job.follow:
             print("[*] Following the series for new episodes...")
-        
-        print(f"[*] Downloading episodes {EPISODE_RANGE[0]} to {EPISODE_RANGE[1]}")
+            if follow_from_api(job):
+                return
 
-        for episode in range(EPISODE_RANGE[0], EPISODE_RANGE[1]+1):
-            for i in range(MAX_RETRIES):
-                try:
-                    EPISODE_NUMBER = episode
-                    Miruro_URL =  Miruro_URL.rsplit("&ep=", 1)[0]
-                    Miruro_URL = f"{Miruro_URL}&ep={episode}"
-                    print(f"Miruro URL: {Miruro_URL}")
-                    print(f"Downloading episode {episode}")
-                    kwik_f_url = get_kwik_download_page(Miruro_URL)
-                    get_kwik_download_link(kwik_f_url)
-                    saved = os.path.join(OUTPUT_DIR, OUTPUT_NAME)
-                    print(f"\n[OK] Done! File saved to: {saved}\n")
-                    break  # Exit retry loop on success
-                except KeyboardInterrupt:
-                    print("\n[!] Cancelled by user.")
-                    conn.close()
-                    sys.exit(3) # 3 for user cancellation
-                except Exception as exc:  # pylint: disable=broad-except
-                    print(f"\n[!] Error: {exc}\n")
-                    if args.debug:
-                        raise
-                if i == MAX_RETRIES - 1:
-                    print("Max retries reached. Exiting.")
-                    try:
-                        cursor.execute('''
-                            UPDATE series
-                            SET download_failed = 1
-                            WHERE miruro_id = ?
-                        ''', (SERIES_ID,))
-                        conn.commit()
-                    except Exception as e:
-                        print(f"Error setting download_failed to true: {e}")
-                    conn.close()
-                    sys.exit(2) # 2 for download failure
-                print(f"Retrying... Attempt ({i+2}/{MAX_RETRIES}) in {config.get('retryDelay', 5)} seconds...")
-                time.sleep(config.get("retryDelay", 5))
-    finally:
+        print(f"[*] Downloading episodes {episode_range[0]} to {episode_range[1]}")
 
+        miruro_url = job.url
+        with sync_playwright() as p:
+            job.pool = BrowserPool(p, headless=config.get("headless", False) and not job.debug)
+            job.pages = ExitStack()
+            try:
+                for episode in range(episode_range[0], episode_range[1]+1):
+                    job.metrics = metrics.EpisodeMetrics(job.job_id, job.series_id, episode)
+                    for i in range(MAX_RETRIES):
+                        job.metrics.begin_attempt(i + 1)
+                        try:
+                            job.check_cancelled()
+                            job.episode_number = episode
+                            miruro_url = miruro_url.rsplit("&ep=", 1)[0]
+                            miruro_url = f"{miruro_url}&ep={episode}"
+                            print(f"Miruro URL: {miruro_url}")
+                            print(f"Downloading episode {episode}")
+                            emit(job, "episode_started", index=episode - episode_range[0] + 1,
+                                 total=episode_range[1] - episode_range[0] + 1, attempt=i + 1)
+                            kwik_f_url = get_kwik_download_page(job, miruro_url)
+                            get_kwik_download_link(job, kwik_f_url)
+                            saved = os.path.join(OUTPUT_DIR, job.output_name)
+                            print(f"\n[OK] Done! File saved to: {saved}\n")
+                            emit(job, "episode_done", path=saved, title=job.series_title)
+                            metrics.save(job.metrics)
+                            if job.on_episode_done:
+                                job.on_episode_done(episode)
+                            break  # Exit retry loop on success
+                        except KeyboardInterrupt:
+                            print("\n[!] Cancelled by user.")
+                            raise DownloadError(3, "Cancelled by user.") # 3 for user cancellation
+                        except DownloadError:
+                            raise
+                        except Exception as exc:  # pylint: disable=broad-except
+                            print(f"\n[!] Error: {exc}\n")
+                            job.metrics.fail()  # Closes the stage that raised, the retry delay is not part of it
+                            drop_miruro_page(job)
+                            emit(job, "retry", attempt=i + 1, error=str(exc))
+                            if job.debug:
+                                raise
+                        if i == MAX_RETRIES - 1:
+                            print("Max retries reached. Exiting.")
+                            metrics.save(job.metrics, ok=False)
+                            try:
+                                job.cursor.execute('''
+                                    UPDATE series
+                                    SET download_failed = 1
+                                    WHERE miruro_id = ?
+                                ''', (job.series_id,))
+                                job.conn.commit()
+                            except Exception as e:
+                                print(f"Error setting download_failed to true: {e}")
+                            raise DownloadError(2, "Max retries reached.") # 2 for download failure
+                        print(f"Retrying... Attempt ({i+2}/{MAX_RETRIES}) in {config.get('retryDelay', 5)} seconds...")
+                        time.sleep(config.get("retryDelay", 5))
+            finally:
+                job.pages.close()
+                job.pool.close()
+                print(f"[*] Browser pool: {job.pool.summary()}")
+                print(f"[*] Metadata cache: {metadata.summary()}")
+    finally:
+        if job.conn and job.conn.in_transaction:
+            # The connection belongs to this worker thread and outlives the job, never leave a write open on it
+            job.conn.rollback()
+        jellyfin.REFRESH.end()
         portalocker.unlock(lock_file)
         lock_file.close()
         print("[*] Download process completed. Lock released.")
 
+def main() -> None:
+    # Thin wrapper for manual runs. The bot drives the same pipeline in-process through engine.py
+    load_settings()
+    args = parse_args()
+    if args.scan:
+        db.init()
+        LIBRARY.full_scan()
+    if args.repair:
+        repair_library()
+    if args.refresh_jellyfin:
+        trigger_jellyfin_scan()
+    if args.scan or args.repair or args.refresh_jellyfin:
+        sys.exit(0)
+    job = DownloadJob(args.url, episode=args.episode, episodes=args.episodes, dub=args.dub, follow=args.follow, debug=args.debug)
+    progress_file = None
+    if args.progress_json:
+        if args.progress_json == "-":
+            progress_file = sys.stdout
+            sys.stdout = sys.stderr  # The log lines go to stderr so stdout carries nothing but the JSON events
+        else:
+            progress_file = open(args.progress_json, "a", encoding="utf-8")
+        job.on_progress = lambda event: print(json.dumps(event), file=progress_file, flush=True)
+    try:
+        run_job(job)
+    except KeyboardInterrupt:
+        print("\n[!] Cancelled by user.")
+        sys.exit(3)
+    except DownloadError as e:
+        sys.exit(e.code)
+    finally:
+        jellyfin.REFRESH.flush()  # Do not leave the refresh to a timer that dies with the process
+        if progress_file and args.progress_json != "-":
+            progress_file.close()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import db
+import download
+from job_queue import JobQueue, LEASE_SECONDS, PRIORITY_BACKFILL
+
+# In-process download engine used by bot.py. Each job runs the download.py pipeline on a worker
+# thread (the Playwright sync API is thread-bound), so the bot shares one interpreter, one config
+# and the resident browsers instead of spawning `python download.py` per request.
+#
+# Up to maxConcurrentDownloads jobs run at once, highest priority first. Jobs for the same series
+# still run one at a time since they write the same files and rows; download.py also holds a
+# per-series file lock so manual runs are covered too.
+#
+# Every job is also a row in the jobs table of hue.db (see job_queue.py). resume() picks up whatever
+# was queued or running when the bot last stopped, continuing ranges after the last finished episode.
+
+class DownloadEngine:
+    def __init__(self):
+        download.load_settings()
+        self.max_concurrent = max(1, int(download.config.get("maxConcurrentDownloads", 2)))
+        self.queue = JobQueue()
+        self.waiting = []  # Heap of (-priority, order, future) for jobs waiting on a slot
+        self.order = itertools.count()
+        self.series_locks = {}
+        self.jobs = []  # Jobs that have not finished yet
+        self.running = 0
+        self.completed = 0
+        self.wait_times = []  # Seconds each started job spent queued, most recent last
+        self.reaper = None
+        self.on_airtime = None  # Set by the bot to its scheduler's update(series_id, airtime), called from worker threads
+
+    async def submit(self, url, episode=None, episodes=None, dub=False, follow=False, kind="download", priority=PRIORITY_BACKFILL):
+        series_id = download.series_id_from_url(url)
+        job_id = await db.run(lambda: self.queue.add(kind, url, miruro_id=series_id, episode=episode, episodes=episodes,
+                                                     dub=dub, follow=follow, priority=priority))
+        return self._schedule(job_id, kind, priority, url, episode=episode, episodes=episodes, dub=dub, follow=follow)
+
+    async def follow(self, url):
+        # A follow only needs the series row, which the API usually has. That runs right away on a worker
+        # thread instead of waiting for a slot and the series lock behind a long backfill; a page job is
+        # only queued when the API falls short. Returns the job with its returncode set
+        job = download.DownloadJob(url, follow=True)
+        job.on_airtime = self._airtime_changed
+        try:
+            if await asyncio.to_thread(download.follow_from_api, job):
+                job.returncode = 0
+                return job
+        except download.DownloadError as e:
+            print(f"[X] Follow of {url} ended with code {e.code}: {e}")
+            job.returncode = e.code
+            return job
+        job = await self.submit(url, follow=True, kind="follow", priority=PRIORITY_BACKFILL)
+        await job.task
+        return job
+
+    def _schedule(self, job_id, kind, priority, url, episode=None, episodes=None, dub=False, follow=False):
+        job = download.DownloadJob(url, episode=episode, episodes=episodes, dub=dub, follow=follow)
+        job.job_id = job_id
+        job.kind = kind
+        job.priority = priority
+        job.on_episode_done = lambda episode: self.queue.record_progress(job_id, episode)
+        job.on_airtime = self._airtime_changed
+        job.listeners = []  # Progress callbacks registered with watch(), run on the event loop
+        loop = asyncio.get_running_loop()
+        job.on_progress = lambda event: loop.call_soon_threadsafe(self._progress, job, event)
+        job.queued_at = time.monotonic()
+        job.task = asyncio.create_task(self._run(job))
+        self.jobs.append(job)
+        return job
+
+    async def resume(self):
+        # Called on startup (and by the reaper). Returns the resumed jobs so the bot can reattach its follow-up work
+        await db.run(self.queue.prune)
+        await db.run(self.queue.reclaim_expired)
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self._reap_expired())
+
+        resumed = []
+        scheduled = {job.job_id for job in self.jobs}
+        for job_id, kind, miruro_id, url, episode, episodes, dub, follow, priority, last_episode in await db.run(self.queue.pending):
+            if job_id in scheduled:
+                continue  # Already waiting in this process
+            if last_episode is not None:
+                if episodes and "-" in episodes and last_episode < int(episodes.split("-")[1]):
+                    episodes = f"{last_episode + 1}-{episodes.split('-')[1]}"
+                else:
+                    # Every episode of the job was already saved before the restart
+                    await db.run(self.queue.finish, job_id, 0)
+                    continue
+            print(f"[*] Resuming {kind} job {job_id} for {url} (episode: {episode}, episodes: {episodes})")
+            resumed.append(self._schedule(job_id, kind, priority, url, episode=episode, episodes=episodes,
+                                          dub=bool(dub), follow=bool(follow)))
+        return resumed
+
+    async def _reap_expired(self):
+        # Jobs left running by another bot process come back once their lease runs out
+        while True:
+            await asyncio.sleep(LEASE_SECONDS)
+            try:
+                if await db.run(self.queue.reclaim_expired):
+                    await self.resume()
+            except Exception as e:
+                print(f"[!] Could not reclaim expired jobs: {e}")
+
+    def watch(self, job, callback):
+        # callback(event) is called on the event loop with every progress event of the job (see download.emit)
+        job.listeners.append(callback)
+
+    def _progress(self, job, event):
+        job.last_progress = event
+        for callback in list(job.listeners):
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[!] Progress listener failed: {e}")
+
+    def _airtime_changed(self, series_id, airtime):
+        if self.on_airtime:
+            self.on_airtime(series_id, airtime)
+
+    def start_library_watcher(self):
+        # Keeps episodes.downloaded in step with outputDir while the bot runs (see library.py)
+        return download.LIBRARY.start_watcher()
+
+    def has_job(self, series_id, kind=None):
+        return any(download.series_id_from_url(job.url) == series_id and kind in (None, job.kind) for job in self.jobs)
+
+    @property
+    def queue_depth(self):
+        return len(self.jobs) - self.running
+
+    async def stats(self):
+        waits = sorted(self.wait_times)
+        return {
+            "running": self.running,
+            "queued": self.queue_depth,
+            "max_concurrent": self.max_concurrent,
+            "completed": self.completed,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": waits[-1] if waits else 0.0,
+            "stored": await db.run(self.queue.counts),
+        }
+
+    def _series_lock(self, url):
+        series_id = download.series_id_from_url(url) or url
+        if series_id not in self.series_locks:
+            self.series_locks[series_id] = asyncio.Lock()
+        return self.series_locks[series_id]
+
+    async def _acquire_slot(self, job):
+        if self.running < self.max_concurrent and not self.waiting:
+            self.running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (-job.priority, next(self.order), future))
+        try:
+            await future  # _release_slot hands its slot over directly, so running is already counted
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            else:
+                self.waiting = [entry for entry in self.waiting if entry[2] is not future]
+                heapq.heapify(self.waiting)
+            raise
+
+    def _release_slot(self):
+        while self.waiting:
+            future = heapq.heappop(self.waiting)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    async def _heartbeat(self, job):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            await db.run(self.queue.renew, job.job_id)
+
+    async def _run(self, job):
+        heartbeat = None
+        try:
+            # Take the series lock before a slot so a job waiting on its series does not hold one
+            async with self._series_lock(job.url):
+                await self._acquire_slot(job)
+                try:
+                    waited = time.monotonic() - job.queued_at
+                    self.wait_times = (self.wait_times + [waited])[-200:]
+                    print(f"[*] Starting job {job.job_id} for {job.url} after {waited:.1f}s in queue "
+                          f"(running {self.running}/{self.max_concurrent}, queued {self.queue_depth})")
+                    await db.run(self.queue.start, job.job_id)
+                    self._progress(job, {"event": "started", "job": job.job_id, "waited": round(waited, 1)})
+                    heartbeat = asyncio.create_task(self._heartbeat(job))
+                    job.check_cancelled()
+                    worker = asyncio.ensure_future(asyncio.to_thread(download.run_job, job))
+                    try:
+                        await asyncio.shield(worker)
+                    except asyncio.CancelledError:
+                        # The worker thread cannot be interrupted, ask it to stop at its next checkpoint and
+                        # keep the slot and the series lock until it has, so nothing else starts on its files
+                        job.cancel()
+                        await asyncio.gather(worker, return_exceptions=True)
+                        raise
+                finally:
+                    self._release_slot()
+            job.returncode = 0
+        except asyncio.CancelledError:
+            # The row goes back to queued so the job resumes on the next start
+            job.cancel()
+            job.returncode = 3
+            await db.run(self.queue.requeue, job.job_id)
+            raise
+        except download.DownloadError as e:
+            print(f"[X] Job for {job.url} ended with code {e.code}: {e}")
+            job.returncode = e.code
+        except Exception as e:
+            print(f"[!] Unexpected error in job for {job.url}: {e}")
+            job.returncode = 1  # Same code an uncaught exception gave the old subprocess
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+            self.jobs.remove(job)
+            self.completed += 1
+        await db.run(self.queue.finish, job.job_id, job.returncode)
+        return job.returncode
@@ -0,0 +1,37 @@
+from urllib.parse import urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+# Sends the requests for a site to another server, e.g. {"kwik.si": "http://127.0.0.1:8765"}. Used by
+# bench.py to run the whole pipeline against local stand-ins: the pages and selectors keep their real
+# https://kwik.si/... URLs, only the connection goes elsewhere. Set from "hostOverrides" in
+# config.json by download.load_settings(); empty in normal use, and then nothing is rewritten.
+
+OVERRIDES = {}  # host -> base URL
+
+def configure(overrides):
+    OVERRIDES.clear()
+    OVERRIDES.update({host.lower(): base.rstrip("/") for host, base in (overrides or {}).items()})
+
+def rewrite(url):
+    if not OVERRIDES or not url:
+        return url
+    parts = urlsplit(url)
+    base = OVERRIDES.get((parts.hostname or "").lower())
+    if not base:
+        return url
+    target = urlsplit(base)
+    return urlunsplit((target.scheme, target.netloc, parts.path, parts.query, parts.fragment))
+
+class OverrideAdapter(HTTPAdapter):
+    # Rewrites after the request is prepared, so cookies and headers are still those of the real host
+    def send(self, request, **kwargs):
+        request.url = rewrite(request.url)
+        return super().send(request, **kwargs)
+
+def mount(session):
+    if OVERRIDES:
+        adapter = OverrideAdapter()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return session
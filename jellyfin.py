@@ -0,0 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Every call to the Jellyfin API goes through this client: one pooled requests.Session with
+# timeouts, and retries for refused connections and the 503s Jellyfin answers while it starts up.
+# Only idempotent requests are retried on a 503; POST /Users/New may already have created the user.
+# download.py calls it directly from its worker thread. The bot uses the *_async methods, which
+# run the request on a small thread pool so a slow Jellyfin never stalls the Discord event loop.
+#
+# The API address defaults to the local server. Set JELLYFIN_API_URL in .env to use another one,
+# e.g. a stand-in server when testing.
+
+DEFAULT_URL = "http://localhost:8096"
+TIMEOUT = (5, 30)  # (connect, read) seconds
+RETRIES = 3
+POOL_SIZE = 4
+
+# Refresh batching, see RefreshCoordinator
+DEBOUNCE_SECONDS = 15
+MAX_DELAY_SECONDS = 30 * 60
+
+_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="jellyfin")
+_client = None
+_client_lock = threading.Lock()
+
+class JellyfinError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Jellyfin answered {status}: {message}")
+        self.status = status
+        self.message = message
+
+class JellyfinClient:
+    def __init__(self, base_url=None, api_key=None, timeout=TIMEOUT, retries=RETRIES):
+        self.base_url = (base_url or os.getenv("JELLYFIN_API_URL") or DEFAULT_URL).rstrip("/")
+        self.api_key = api_key if api_key is not None else os.getenv("JELLYFIN_API_KEY")
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=0.5,
+                      status_forcelist=(503,), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["X-Emby-Token"] = self.api_key or ""
+
+    def request(self, method, path, **kwargs):
+        # Returns the response, raises JellyfinError for anything but 2xx and requests.RequestException if unreachable
+        response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        if not 200 <= response.status_code < 300:
+            raise JellyfinError(response.status_code, response.text)
+        return response
+
+    def create_user(self, name, password, device_id):
+        # device_id is the Discord user's id, so Jellyfin keeps one device session per Discord user as before
+        payload = {
+            "Name": name,
+            "Password": password,
+            "IsAdministrator": False,  # Set to True if you want the user to have admin rights
+            "EnableUserPreferenceAccess": True,
+            "EnablePublicSharing": False,
+            "EnableSyncTranscoding": True
+        }
+        headers = {"X-Emby-Authorization": f'MediaBrowser Client="AutoBot", Device="DiscordBot", '
+                                           f'DeviceId="{device_id}", Version="1.0.0", Token="{self.api_key}"'}
+        response = self.request("POST", "/Users/New", json=payload, headers=headers)
+        return response.json() if response.content else None
+
+    def refresh_library(self):
+        # Rescans every library, only used when asked for
+        self.request("POST", "/Library/Refresh")
+
+    def media_updated(self, paths, update_type="Created"):
+        # Jellyfin only looks at the folders these paths are in. Sending it twice does no harm, so unlike
+        # the other POSTs it is retried while Jellyfin answers 503
+        updates = [{"Path": path, "UpdateType": update_type} for path in paths]
+        for attempt in range(self.retries + 1):
+            try:
+                self.request("POST", "/Library/Media/Updated", json={"Updates": updates})
+                return
+            except JellyfinError as e:
+                if e.status != 503 or attempt == self.retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+
+    def close(self):
+        self.session.close()
+
+    # Async versions for the bot
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(_executor, function, *args)
+
+    async def create_user_async(self, name, password, device_id):
+        return await self.run(self.create_user, name, password, device_id)
+
+class RefreshCoordinator:
+    # Collects the files written by downloads and tells Jellyfin about just those paths in one call.
+    # While any job is still running (begin/end) the paths are held, so a 25 episode backfill ends in
+    # a single refresh. Once the last job ends the call goes out after DEBOUNCE_SECONDS of quiet, and
+    # never later than MAX_DELAY_SECONDS after the first path came in.
+    def __init__(self, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.path_map = None  # (local outputDir, outputDir as Jellyfin sees it) when they differ
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.first_added = None
+        self.active = 0
+        self.timer = None
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+
+    def end(self):
+        with self.lock:
+            self.active = max(0, self.active - 1)
+            self._arm()
+
+    def add(self, path):
+        with self.lock:
+            self.paths.add(os.path.abspath(path))
+            if self.first_added is None:
+                self.first_added = time.monotonic()
+            self._arm()
+
+    def _arm(self):
+        # Called with the lock held
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.paths:
+            return
+        waited = time.monotonic() - self.first_added
+        if self.active:
+            delay = self.max_delay - waited
+        else:
+            delay = min(self.debounce, self.max_delay - waited)
+        self.timer = threading.Timer(max(0.0, delay), self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _jellyfin_path(self, path):
+        if not self.path_map:
+            return path
+        local, remote = self.path_map
+        relative = os.path.relpath(path, local)
+        if relative.startswith(".."):
+            return path
+        return remote.rstrip("/\\") + "/" + relative.replace(os.sep, "/")
+
+    def flush(self):
+        # Sends whatever is pending now. Manual runs call this before exiting
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            paths, self.paths = sorted(self.paths), set()
+            self.first_added = None
+        if not paths:
+            return 0
+        try:
+            client().media_updated([self._jellyfin_path(path) for path in paths])
+            print(f"[OK] Asked Jellyfin to pick up {len(paths)} new file(s).")
+        except JellyfinError as e:
+            print(f"[X] Failed to notify Jellyfin of {len(paths)} new file(s). Status: {e.status}")
+        except requests.RequestException as e:
+            print(f"[X] Failed to notify Jellyfin of {len(paths)} new file(s): {e}")
+        return len(paths)
+
+REFRESH = RefreshCoordinator()
+
+def client():
+    # Shared client, created on first use so .env has been loaded by then
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = JellyfinClient()
+    return _client
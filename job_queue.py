@@ -0,0 +1,111 @@
+import db
+
+# Durable download queue stored in hue.db next to series/episodes/follows. Every job the engine
+# runs has a row here, so a bot restart picks up queued work and half finished ranges instead of
+# losing them.
+#
+# States: queued -> running -> done | failed. A running job holds a lease that the engine renews
+# while the worker is alive. If the bot dies the lease runs out and the job is queued again.
+
+# Higher runs first
+PRIORITY_INTERACTIVE = 20  # /download
+PRIORITY_SCHEDULED = 10    # New episodes found by the scheduler
+PRIORITY_BACKFILL = 0      # /follow backfills and series info
+
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3  # A job that keeps dying mid-run (crash, restart) is given up on after this many starts
+KEEP_FINISHED_DAYS = 7
+
+class JobQueue:
+    # The jobs table itself is created by db.init(). Progress is written from worker threads,
+    # which each use their own connection from db.connect(). The methods block, the engine calls
+    # them through db.run() so the event loop is not held up by a busy database
+
+    def _execute(self, query, params=()):
+        return db.execute(query, params)
+
+    def add(self, kind, url, miruro_id=None, episode=None, episodes=None, dub=False, follow=False, priority=PRIORITY_BACKFILL):
+        return db.insert('''
+            INSERT INTO jobs (kind, miruro_id, url, episode, episodes, dub, follow, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (kind, miruro_id, url, episode, episodes, dub, follow, priority))
+
+    def start(self, job_id):
+        self._execute(f'''
+            UPDATE jobs
+            SET state = 'running', attempts = attempts + 1,
+                lease_expires = datetime('now', '+{LEASE_SECONDS} seconds'), updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (job_id,))
+
+    def renew(self, job_id):
+        self._execute(f'''
+            UPDATE jobs
+            SET lease_expires = datetime('now', '+{LEASE_SECONDS} seconds'), updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND state = 'running'
+        ''', (job_id,))
+
+    def record_progress(self, job_id, episode):
+        self._execute('''
+            UPDATE jobs SET last_episode = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (episode, job_id))
+
+    def finish(self, job_id, returncode):
+        state = "done" if returncode == 0 else "failed"
+        self._execute('''
+            UPDATE jobs
+            SET state = ?, returncode = ?, lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (state, returncode, job_id))
+
+    def requeue(self, job_id):
+        # Used when the bot shuts down mid-job, the next start resumes it
+        self._execute('''
+            UPDATE jobs
+            SET state = 'queued', lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (job_id,))
+
+    def reclaim_expired(self):
+        # Running jobs whose owner stopped renewing the lease. Jobs that already used up their attempts fail instead
+        with db.transaction() as conn:
+            failed = conn.execute('''
+                UPDATE jobs SET state = 'failed', returncode = 2, lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE state = 'running' AND lease_expires < datetime('now') AND attempts >= ?
+            ''', (MAX_ATTEMPTS,)).rowcount
+            reclaimed = conn.execute('''
+                UPDATE jobs SET state = 'queued', lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE state = 'running' AND lease_expires < datetime('now')
+            ''').rowcount
+        if failed:
+            print(f"[!] Gave up on {failed} job(s) that died {MAX_ATTEMPTS} times.")
+        if reclaimed:
+            print(f"[*] Requeued {reclaimed} job(s) with an expired lease.")
+        return reclaimed
+
+    def pending(self):
+        # Queued jobs, highest priority first and oldest first within a priority. A job that was requeued
+        # at shutdown or reclaimed keeps its attempts, one that was already started MAX_ATTEMPTS times
+        # (e.g. it keeps taking the worker down) fails here instead of running on every restart
+        with db.transaction() as conn:
+            failed = conn.execute('''
+                UPDATE jobs SET state = 'failed', returncode = 2, lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE state = 'queued' AND attempts >= ?
+            ''', (MAX_ATTEMPTS,)).rowcount
+            rows = conn.execute('''
+                SELECT id, kind, miruro_id, url, episode, episodes, dub, follow, priority, last_episode
+                FROM jobs WHERE state = 'queued'
+                ORDER BY priority DESC, id ASC
+            ''').fetchall()
+        if failed:
+            print(f"[!] Gave up on {failed} queued job(s) that were already started {MAX_ATTEMPTS} times.")
+        return rows
+
+    def counts(self):
+        return dict(db.fetchall('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def prune(self):
+        self._execute(f'''
+            DELETE FROM jobs
+            WHERE state IN ('done', 'failed') AND updated_at < datetime('now', '-{KEEP_FINISHED_DAYS} days')
+        ''')
@@ -0,0 +1,188 @@
+import os
+import re
+import threading
+
+import db
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Not on Linux or not installed, the index then relies on full scans
+    INotify = None
+
+# Index of the episode files under outputDir, kept in the library_files table of hue.db. A full
+# scan builds it, and while the bot runs an inotify watcher keeps it current. Adding or removing a
+# file also flips episodes.downloaded, so the table follows the disk instead of drifting until the
+# next failed download notices.
+
+EPISODE_FILE = re.compile(r'^(?P<title>.+) S(?P<season>\d+)E(?P<episode>\d+)\.mp4$')
+SEASON_DIR = re.compile(r'^Season (\d+)$')
+
+def parse_episode_path(output_dir, path):
+    # (series title, season, episode) for output_dir/<title>/Season NN/<title> SNNENN.mp4, otherwise None
+    relative = os.path.relpath(path, output_dir).split(os.sep)
+    if len(relative) != 3 or not SEASON_DIR.match(relative[1]):
+        return None
+    match = EPISODE_FILE.match(relative[2])
+    if not match or match.group("title") != relative[0]:
+        return None
+    return relative[0], int(match.group("season")), int(match.group("episode"))
+
+class LibraryIndex:
+    def __init__(self, output_dir):
+        self.output_dir = os.path.abspath(output_dir)
+        self.watcher = None
+
+    @property
+    def watching(self):
+        return self.watcher is not None and self.watcher.is_alive()
+
+    def _mark(self, conn, title, season, episode, downloaded):
+        conn.execute('''
+            UPDATE episodes SET downloaded = ?
+            WHERE season = ? AND episode = ?
+              AND miruro_id IN (SELECT miruro_id FROM series WHERE title = ? AND season = ?)
+        ''', (downloaded, season, episode, title, season))
+
+    def _add(self, conn, path):
+        parsed = parse_episode_path(self.output_dir, path)
+        if not parsed:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        conn.execute('''
+            INSERT OR REPLACE INTO library_files (path, series_title, season, episode, size, mtime)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (path, *parsed, stat.st_size, stat.st_mtime))
+        self._mark(conn, *parsed, 1)
+        return True
+
+    def _remove(self, conn, path):
+        # path may be a directory that was deleted or moved away, everything under it goes
+        rows = conn.execute('''
+            SELECT path, series_title, season, episode FROM library_files
+            WHERE path = ? OR path LIKE ? ESCAPE '\\'
+        ''', (path, self._like_prefix(path))).fetchall()
+        for file_path, title, season, episode in rows:
+            conn.execute('DELETE FROM library_files WHERE path = ?', (file_path,))
+            self._mark(conn, title, season, episode, 0)
+            print(f"[*] Library: {os.path.basename(file_path)} was removed, marked as not downloaded.")
+        return len(rows)
+
+    @staticmethod
+    def _like_prefix(path):
+        escaped = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return escaped + ("\\\\" if os.sep == "\\" else os.sep) + "%"
+
+    def full_scan(self, root=None):
+        # Rebuilds the index for root (default outputDir) and reconciles episodes.downloaded with it
+        root = os.path.abspath(root or self.output_dir)
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if parse_episode_path(self.output_dir, path):
+                    found.append(path)
+
+        with db.transaction() as conn:
+            known = {row[0] for row in conn.execute('''
+                SELECT path FROM library_files WHERE path = ? OR path LIKE ? ESCAPE '\\'
+            ''', (root, self._like_prefix(root)))}
+            for path in known - set(found):
+                self._remove(conn, path)
+            for path in found:
+                self._add(conn, path)
+            if root == self.output_dir:
+                # Rows flagged as downloaded whose file is nowhere in the tree
+                stale = conn.execute('''
+                    UPDATE episodes SET downloaded = 0
+                    WHERE downloaded = 1 AND NOT EXISTS (
+                        SELECT 1 FROM library_files l JOIN series s ON s.title = l.series_title AND s.season = l.season
+                        WHERE s.miruro_id = episodes.miruro_id AND l.season = episodes.season AND l.episode = episodes.episode
+                    )
+                ''').rowcount
+                if stale:
+                    print(f"[*] Library: {stale} episode(s) marked downloaded had no file, marked as not downloaded.")
+        print(f"[*] Library: indexed {len(found)} episode file(s) under {root}.")
+        return len(found)
+
+    def lookup(self, title, season, episode):
+        # Path of the episode file or None. Without a running watcher (manual download.py runs) the
+        # index may be stale, so a hit is confirmed on disk and corrected if the file is gone
+        row = db.fetchone('''
+            SELECT path FROM library_files WHERE series_title = ? AND season = ? AND episode = ?
+        ''', (title, season, episode))
+        path = row[0] if row else None
+        if self.watching:
+            return path
+
+        expected = os.path.join(self.output_dir, title, f"Season {season:02}", f"{title} S{season:02}E{episode:02}.mp4")
+        with db.transaction() as conn:
+            if path and not os.path.exists(path):
+                self._remove(conn, path)
+                path = None
+            if not path and os.path.exists(expected):
+                self._add(conn, expected)
+                path = expected
+        return path
+
+    def start_watcher(self):
+        if self.watching:
+            return True
+        self.full_scan()
+        if INotify is None:
+            print("[!] inotify is not available, the library index is only updated by full scans.")
+            return False
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.watcher = threading.Thread(target=self._watch, name="library-watcher", daemon=True)
+        self.watcher.start()
+        return True
+
+    def _watch(self):
+        mask = (flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                flags.DELETE | flags.DELETE_SELF)
+        inotify = INotify()
+        directories = {}
+
+        def watch_tree(root):
+            for dirpath, dirnames, filenames in os.walk(root):
+                try:
+                    directories[inotify.add_watch(dirpath, mask)] = dirpath
+                except OSError as e:
+                    print(f"[!] Library: cannot watch {dirpath}: {e}")
+
+        watch_tree(self.output_dir)
+        print(f"[*] Library: watching {self.output_dir} ({len(directories)} directories).")
+        conn = db.connect()
+        try:
+            while True:  # Daemon thread, runs as long as the bot
+                events = inotify.read()
+                if not events:
+                    continue
+                with conn:
+                    for event in events:
+                        if event.mask & flags.IGNORED:
+                            directories.pop(event.wd, None)
+                            continue
+                        dirpath = directories.get(event.wd)
+                        if not dirpath or not event.name:
+                            continue
+                        path = os.path.join(dirpath, event.name)
+                        if event.mask & flags.ISDIR:
+                            if event.mask & (flags.CREATE | flags.MOVED_TO):
+                                # Files can land before the watch is in place, so the new tree is scanned once
+                                watch_tree(path)
+                                for subdir, _, filenames in os.walk(path):
+                                    for name in filenames:
+                                        self._add(conn, os.path.join(subdir, name))
+                            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                                self._remove(conn, path)
+                        elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                            self._add(conn, path)
+                        elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                            self._remove(conn, path)
+        except Exception as e:
+            print(f"[!] Library watcher stopped: {e}")
+        finally:
+            inotify.close()
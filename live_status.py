@@ -0,0 +1,105 @@
+import asyncio
+import datetime
+
+from transfer import format_bytes
+
+# Keeps a /download reply up to date while the job runs. The engine hands every progress event
+# (see download.emit) to update() on the event loop; the message is edited with the latest one at
+# most every edit_seconds, so a fast transfer does not run into Discord's rate limit on webhook
+# edits. Interaction tokens expire 15 minutes after the interaction came in (not after this object
+# was made, the command may have spent a while before that), after that the message is left alone
+# and the final result goes out through edit_or_send as before.
+
+EDIT_SECONDS = 3
+TOKEN_LIFETIME = 14 * 60  # A minute short of the 15 Discord gives us
+
+STAGES = {  # download.STAGE_DEADLINES names
+    "miruro_ready": "Loading the episode page",
+    "miruro_episode": "Moving to the next episode",
+    "miruro_sources": "Loading the episode's sources",
+    "airing_info": "Reading the series info",
+    "mal_link": "Reading the series info",
+    "server_list": "Looking for the download server",
+    "kiwi_selected": "Looking for the download server",
+    "download_button": "Opening the download link",
+    "pahe_redirect": "Following the download link",
+    "kwik_ready": "Opening the download page",
+    "kwik_popup": "Opening the download page",
+    "kwik_form": "Starting the download",
+}
+
+def progress_bar(fraction, width=20):
+    filled = int(round(max(0.0, min(1.0, fraction)) * width))
+    return "█" * filled + "░" * (width - filled)
+
+def render(header, event):
+    lines = [header]
+    episode = event.get("episode")
+    if event.get("total"):
+        lines.append(f"Episode {episode} ({event.get('index', '?')}/{event['total']})")
+    elif episode:
+        lines.append(f"Episode {episode}")
+
+    kind = event.get("event")
+    if kind == "started":
+        lines.append("Starting...")
+    elif kind == "episode_started":
+        attempt = event.get("attempt", 1)
+        lines.append("Finding the episode..." + (f" (attempt {attempt})" if attempt > 1 else ""))
+    elif kind == "stage":
+        lines.append(STAGES.get(event.get("stage"), event.get("stage", "Working")) + "...")
+    elif kind == "transfer":
+        received, expected = event.get("bytes", 0), event.get("size")
+        rate = f"{format_bytes(event.get('rate', 0))}/s"
+        if expected:
+            lines.append(f"`{progress_bar(received / expected)}` {received / expected:.0%}")
+            lines.append(f"{format_bytes(received)} of {format_bytes(expected)} at {rate}")
+        else:
+            lines.append(f"{format_bytes(received)} at {rate}")
+    elif kind == "episode_done":
+        lines.append("[+] Episode saved.")
+    elif kind == "retry":
+        lines.append(f"[!] Attempt {event.get('attempt')} failed, retrying...")
+    return "\n".join(lines)
+
+class LiveStatus:
+    def __init__(self, msg, header, started_at=None, edit_seconds=EDIT_SECONDS):
+        self.msg = msg
+        self.header = header
+        self.edit_seconds = edit_seconds
+        self.started_at = started_at or datetime.datetime.now(datetime.timezone.utc)  # interaction.created_at
+        self.latest = None
+        self.context = {}  # index/total of the current episode, the later events do not repeat them
+        self.changed = asyncio.Event()
+        self.closed = False
+        self.edits = 0
+        self.task = asyncio.create_task(self._run())
+
+    def update(self, event):
+        if event.get("event") == "episode_started":
+            self.context = {"index": event.get("index"), "total": event.get("total")}
+        self.latest = {**self.context, **event}
+        self.changed.set()
+
+    def expired(self):
+        return (datetime.datetime.now(datetime.timezone.utc) - self.started_at).total_seconds() > TOKEN_LIFETIME
+
+    async def _run(self):
+        while not self.closed and not self.expired():
+            await self.changed.wait()
+            self.changed.clear()
+            if self.closed or self.expired():
+                break
+            try:
+                await self.msg.edit(content=render(self.header, self.latest))
+                self.edits += 1
+            except Exception as e:
+                print(f"[!] Could not update the status message: {e}")
+                break  # Expired or deleted, the final result is DMed instead
+            await asyncio.sleep(self.edit_seconds)
+
+    async def close(self):
+        # Stops editing so the final result is not overwritten by a late progress edit
+        self.closed = True
+        self.changed.set()
+        await self.task
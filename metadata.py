@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+import hosts
+import stats_file
+
+# On-disk cache for the miruro metadata APIs. The AniList info and the MAL/TMDB episode list are the
+# same for every episode of a series, so a range download fetches them once and later runs only
+# revalidate them (ETag / Last-Modified) once the TTL runs out.
+
+CACHE_DIR = os.path.join("cache", "metadata")
+STATS_PATH = os.path.join(CACHE_DIR, "stats.json")
+
+# Seconds an entry is used without asking the server. Airing shows gain episodes, finished ones rarely change
+TTL_AIRING = 6 * 60 * 60
+TTL_FINISHED = 7 * 24 * 60 * 60
+REQUEST_TIMEOUT = 30
+
+class MetadataError(Exception):
+    pass
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def load_entry(key):
+    path = cache_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def save_entry(key, entry):
+    # Written to a temp file first so a concurrent reader never sees half a document
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{cache_path(key)}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(entry, file)
+        os.replace(temp_path, cache_path(key))
+    except OSError as e:
+        print(f"[!] Could not cache metadata {key}: {e}")
+
+def count(result):
+    stats_file.update(STATS_PATH, lambda stats: stats.update({result: stats.get(result, 0) + 1}),
+                      "metadata cache stats")
+
+def summary():
+    stats = stats_file.load(STATS_PATH)
+    return ", ".join(f"{stats.get(key, 0)} {key}" for key in ("hits", "revalidated", "misses", "stale"))
+
+def ttl_for(airing, config=None):
+    ttls = (config or {}).get("metadataTTL", {})
+    if airing:
+        return ttls.get("airing", TTL_AIRING)
+    return ttls.get("finished", TTL_FINISHED)
+
+def get_json(url, key, ttl):
+    # Returns the parsed document. Raises MetadataError if it cannot be fetched and nothing is cached
+    entry = load_entry(key)
+    if entry and time.time() - entry["fetched_at"] < ttl:
+        count("hits")
+        return entry["body"]
+
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        response = requests.get(hosts.rewrite(url), headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        if entry:
+            print(f"[!] Metadata request failed, using cached copy of {key}: {e}")
+            count("stale")
+            return entry["body"]
+        raise MetadataError(f"Request for {url} failed: {e}")
+
+    if response.status_code == 304 and entry:
+        entry["fetched_at"] = time.time()
+        save_entry(key, entry)
+        count("revalidated")
+        return entry["body"]
+
+    if response.status_code != 200:
+        if entry:
+            print(f"[!] Metadata request answered {response.status_code}, using cached copy of {key}")
+            count("stale")
+            return entry["body"]
+        raise MetadataError(f"{url} answered {response.status_code}")
+
+    body = response.json()
+    save_entry(key, {
+        "url": url,
+        "fetched_at": time.time(),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "body": body,
+    })
+    count("misses")
+    return body
+
+def anilist_info(series_id, airing, config=None):
+    return get_json(f"https://www.miruro.to/api/info/anilist/{series_id}", f"anilist_{series_id}", ttl_for(airing, config))
+
+def mal_episodes(mal_id, airing, config=None):
+    if not mal_id:
+        raise MetadataError("No MAL ID to fetch the episode list for")  # Never cache it as episodes_None
+    return get_json(f"https://www.miruro.to/api/episodes?malId={mal_id}&ongoing={str(airing).lower()}",
+                    f"episodes_{mal_id}", ttl_for(airing, config))
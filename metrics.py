@@ -0,0 +1,179 @@
+import argparse
+import math
+import sys
+import time
+
+import db
+from transfer import format_bytes
+
+# Where the time of an episode goes. download.py marks the start of each stage of an attempt
+# (mark), the stage runs until the next mark or until it is closed (done/fail), and the finished
+# episode is written to the metrics table of hue.db as one row per stage plus an "episode" row
+# with the total time, bytes and the number of attempts it took.
+#
+# python metrics.py (or /stats in Discord) shows p50/p95 per stage and transfer throughput per
+# series, to tell a slow miruro page from a slow pahe.win redirect or a slow kwik host.
+#
+# Every page wait (download.wait_until) is stored as well, as a "wait:<name>" row that is not ok
+# when it ran into its deadline. The report lists them separately for tuning stageDeadlines.
+
+# Pipeline order, used to sort the report
+STAGES = ["miruro_browser", "miruro_page", "metadata", "server_select", "pahe_redirect",
+          "kwik_browser", "kwik_form", "transfer", "resume", "episode"]
+WAIT_PREFIX = "wait:"
+TRANSFER_STAGES = ("transfer", "resume")
+RETENTION_DAYS = 90
+REPORT_DAYS = 7
+
+class EpisodeMetrics:
+    def __init__(self, job_id, miruro_id, episode):
+        self.job_id = job_id
+        self.miruro_id = miruro_id
+        self.episode = episode
+        self.started = time.monotonic()
+        self.attempt = 0
+        self.stages = []  # (attempt, stage, seconds, bytes, ok)
+        self.current = None  # (stage, start) of the running stage
+        self.waits = []  # (attempt, "wait:<name>", seconds, None, ok)
+
+    def begin_attempt(self, attempt):
+        self.fail()  # Whatever was running when the last attempt raised
+        self.attempt = attempt
+
+    def mark(self, stage):
+        self.done()
+        self.current = (stage, time.monotonic())
+
+    def done(self, transferred=None, ok=True):
+        if self.current is None:
+            return
+        stage, start = self.current
+        self.current = None
+        self.stages.append((self.attempt, stage, time.monotonic() - start, transferred, ok))
+
+    def fail(self):
+        self.done(ok=False)
+
+    def wait(self, name, seconds, ok=True):
+        self.waits.append((self.attempt, WAIT_PREFIX + name, seconds, None, ok))
+
+    def discard(self):
+        # The stage turned out to be a no-op (e.g. nothing to resume)
+        self.current = None
+
+    def bytes(self):
+        return sum(transferred or 0 for _, _, _, transferred, ok in self.stages if ok)
+
+    def rows(self, ok):
+        rows = [(self.job_id, self.miruro_id, self.episode, attempt, stage, seconds, transferred, ok)
+                for attempt, stage, seconds, transferred, ok in self.stages + self.waits]
+        rows.append((self.job_id, self.miruro_id, self.episode, self.attempt, "episode",
+                     time.monotonic() - self.started, self.bytes(), ok))
+        return rows
+
+def save(metrics, ok=True):
+    # Called from the worker thread once the episode is done or out of retries. Never fails the download
+    if ok:
+        metrics.done()
+    else:
+        metrics.fail()
+    if not metrics.stages:
+        return  # Already in the library, nothing was timed
+    try:
+        db.executemany('''
+            INSERT INTO metrics (job_id, miruro_id, episode, attempt, stage, seconds, bytes, ok)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', metrics.rows(ok))
+        db.execute('''
+            DELETE FROM metrics WHERE recorded_at < datetime('now', ?)
+        ''', (f"-{RETENTION_DAYS} days",))
+    except Exception as e:
+        print(f"[!] Could not save episode metrics: {e}")
+
+def percentile(values, fraction):
+    # Nearest rank, values must be sorted
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def stage_summary(days=REPORT_DAYS, job_ids=None, waits=False):
+    # job_ids limits it to those jobs, bench.py reports each scenario on its own. waits=True
+    # summarizes the page waits instead of the pipeline stages
+    query = f'''
+        SELECT stage, seconds, ok FROM metrics
+        WHERE recorded_at >= datetime('now', ?) AND stage {"" if waits else "NOT "}LIKE ?
+    '''
+    params = [f"-{days} days", WAIT_PREFIX + "%"]
+    if job_ids is not None:
+        query += f' AND job_id IN ({", ".join("?" * len(job_ids)) or "NULL"})'
+        params += list(job_ids)
+    rows = db.fetchall(query + ' ORDER BY stage, seconds', params)
+    stages = {}
+    for stage, seconds, ok in rows:
+        entry = stages.setdefault(stage, {"seconds": [], "failed": 0})
+        if ok:
+            entry["seconds"].append(seconds)
+        else:
+            entry["failed"] += 1
+    summary = []
+    for stage in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+        values = stages[stage]["seconds"]
+        summary.append({
+            "stage": stage[len(WAIT_PREFIX):] if waits else stage,
+            "count": len(values),
+            "failed": stages[stage]["failed"],
+            "p50": percentile(values, 0.5) if values else None,
+            "p95": percentile(values, 0.95) if values else None,
+        })
+    return summary
+
+def series_throughput(days=REPORT_DAYS, limit=10):
+    # Transfer rate per series, slowest first, with the average attempts its episodes needed
+    return db.fetchall('''
+        SELECT t.miruro_id, COALESCE(s.title, t.miruro_id), t.transferred, t.seconds, e.episodes, e.attempts
+        FROM (
+            SELECT miruro_id, SUM(bytes) AS transferred, SUM(seconds) AS seconds FROM metrics
+            WHERE stage IN (?, ?) AND ok = 1 AND bytes > 0 AND recorded_at >= datetime('now', ?)
+            GROUP BY miruro_id
+        ) t
+        LEFT JOIN (
+            SELECT miruro_id, COUNT(*) AS episodes, AVG(attempt) AS attempts FROM metrics
+            WHERE stage = 'episode' AND recorded_at >= datetime('now', ?)
+            GROUP BY miruro_id
+        ) e ON e.miruro_id = t.miruro_id
+        LEFT JOIN series s ON s.miruro_id = t.miruro_id
+        ORDER BY t.transferred / t.seconds
+        LIMIT ?
+    ''', (*TRANSFER_STAGES, f"-{days} days", f"-{days} days", limit))
+
+def stage_lines(stages):
+    lines = []
+    for entry in stages:
+        timing = f"p50 {entry['p50']:7.1f}s  p95 {entry['p95']:7.1f}s" if entry["count"] else "p50       -   p95       -"
+        lines.append(f"  {entry['stage']:<16} {timing}  n={entry['count']:<4} failed={entry['failed']}")
+    return lines
+
+def report(days=REPORT_DAYS):
+    stages = stage_summary(days)
+    if not stages:
+        return f"No episodes timed in the last {days} day(s)."
+    lines = [f"Stage timings, last {days} day(s):"] + stage_lines(stages)
+    waits = stage_summary(days, waits=True)
+    if waits:
+        lines += ["Page waits (failed = ran into its stageDeadlines entry):"] + stage_lines(waits)
+    rows = series_throughput(days)
+    if rows:
+        lines.append("Throughput per series (slowest first):")
+    for _, title, transferred, seconds, episodes, attempts in rows:
+        lines.append(f"  {title[:32]:<32} {format_bytes(transferred / max(seconds, 1e-6)):>9}/s  "
+                     f"{format_bytes(transferred):>9} over {episodes or 0} episode(s), "
+                     f"{attempts or 1:.1f} attempt(s) avg")
+    return "\n".join(lines)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Show where download time goes, from the metrics in hue.db.")
+    parser.add_argument("--days", type=int, default=REPORT_DAYS, help="How far back to look (default: %(default)s)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(report(args.days))
+    sys.exit(0)
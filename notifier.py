@@ -0,0 +1,133 @@
+import asyncio
+
+import discord
+
+import db
+
+# Sends the "new episode" DMs for bot.py. notify() only records the episode and returns, so the
+# scheduler goes on to the next download straight away. Episodes of the same series that come in
+# within the coalesce window go out as one DM per follower.
+#
+# Followers are taken from the gateway cache when it has them and only fetched over REST otherwise.
+# DMs are sent concurrently but spaced out, so a series with many followers stays under Discord's
+# rate limits. discord.py already waits out 429s, failed sends are only retried on 5xx.
+
+COALESCE_SECONDS = 30
+MAX_CONCURRENT = 5
+SENDS_PER_SECOND = 5
+MAX_RETRIES = 2
+
+def episode_message(title, episodes, jellyfin_url):
+    if len(episodes) == 1:
+        headline = f"New episode available for **{title}**: Episode {episodes[0]} is now available! "
+    else:
+        headline = f"New episodes available for **{title}**: Episodes {', '.join(map(str, episodes))} are now available! "
+    return f"{headline}\nCheck it out at {jellyfin_url} or on the Swiftfin/Jellyfin app."
+
+class NotificationDispatcher:
+    def __init__(self, bot, jellyfin_url, coalesce_seconds=COALESCE_SECONDS, max_concurrent=MAX_CONCURRENT,
+                 sends_per_second=SENDS_PER_SECOND):
+        self.bot = bot
+        self.jellyfin_url = jellyfin_url
+        self.coalesce_seconds = coalesce_seconds
+        self.max_concurrent = max_concurrent
+        self.interval = 1 / max(1, sends_per_second)
+        self.pending = {}  # miruro_id -> (title, set of episode numbers)
+        self.ready = None
+        self.limit = None
+        self.task = None
+        self.next_send = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.fetched = 0
+
+    def start(self):
+        if self.task:
+            return self.task  # on_ready fires again after a reconnect
+        self.ready = asyncio.Event()
+        self.limit = asyncio.Semaphore(self.max_concurrent)
+        if self.pending:
+            self.ready.set()
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    def notify(self, miruro_id, title, episode):
+        title, episodes = self.pending.setdefault(miruro_id, (title, set()))
+        episodes.add(episode)
+        if self.ready:
+            self.ready.set()
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "pending": sum(len(episodes) for _, episodes in self.pending.values()),
+            "cache_hits": self.cache_hits,
+            "fetched": self.fetched,
+        }
+
+    async def _run(self):
+        while True:
+            await self.ready.wait()
+            await asyncio.sleep(self.coalesce_seconds)  # Let episodes that land together share a DM
+            self.ready.clear()
+            batch, self.pending = self.pending, {}
+            try:
+                await self._dispatch(batch)
+            except Exception as e:
+                print(f"[!] Notification error: {e}")
+
+    async def _dispatch(self, batch):
+        sends = []
+        for miruro_id, (title, episodes) in batch.items():
+            users = await db.fetchall_async('''
+                SELECT user_id FROM follows WHERE miruro_id = ? AND notify = 1
+            ''', (miruro_id,))
+            if not users:
+                print(f"[*] No users to notify for series ID {miruro_id}.")
+                continue
+            content = episode_message(title, sorted(episodes), self.jellyfin_url)
+            sends.extend(self._send(int(user_id), title, content) for (user_id,) in users)
+        await asyncio.gather(*sends)
+
+    async def _resolve(self, user_id):
+        user = self.bot.get_user(user_id)
+        if user:
+            self.cache_hits += 1
+            return user
+        self.fetched += 1
+        return await self.bot.fetch_user(user_id)
+
+    async def _pace(self):
+        # Hands out send times self.interval apart
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self.next_send)
+        self.next_send = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, user_id, title, content):
+        async with self.limit:
+            for attempt in range(MAX_RETRIES + 1):
+                await self._pace()
+                try:
+                    user = await self._resolve(user_id)
+                    await user.send(content)
+                    self.sent += 1
+                    print(f"[+] Notified {user.name} about new episode of {title}.")
+                    return True
+                except discord.Forbidden:
+                    print(f"[!] Could not notify {user_id}: User has DMs disabled.")
+                    break
+                except discord.HTTPException as e:
+                    if e.status < 500 or attempt == MAX_RETRIES:
+                        print(f"[!] Error notifying {user_id}: {e}")
+                        break
+                    await asyncio.sleep(2 ** attempt)
+                except Exception as e:
+                    print(f"[!] Error notifying {user_id}: {e}")
+                    break
+            self.failed += 1
+            return False
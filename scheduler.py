@@ -0,0 +1,149 @@
+import asyncio
+import datetime
+import heapq
+
+import db
+import stats_file
+
+# Wakes the bot when a series is due instead of sweeping hue.db every scanInterval. The heap holds
+# (due time, miruro_id) for every airing series and the loop sleeps until the earliest one. When
+# download.py writes a new airtime the entry is replaced in place; replaced entries stay in the
+# heap and are skipped when they come up.
+#
+# A series is due at its next_episode_time, or right away when its last download failed. Series that
+# were due but got nothing new (not out yet, already queued, failed again) are retried after
+# scanInterval minutes.
+
+STATS_PATH = "scheduler_stats.json"
+MAX_SLEEP = 60 * 60  # Re-reads the clock at least hourly, so a clock change does not leave it sleeping past an airtime
+
+def parse_time(value):
+    # next_episode_time is stored as a naive local timestamp string
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def record_lag(seconds):
+    # Time from an episode's airtime to it being downloaded
+    def change(stats):
+        stats["downloads"] = stats.get("downloads", 0) + 1
+        stats["total_lag"] = stats.get("total_lag", 0.0) + seconds
+        stats["max_lag"] = max(stats.get("max_lag", 0.0), seconds)
+        stats["last_lag"] = seconds
+    stats_file.update(STATS_PATH, change, "scheduler stats")
+
+def lag_summary():
+    stats = stats_file.load(STATS_PATH)
+    if not stats.get("downloads"):
+        return "no scheduled downloads yet"
+    average = stats["total_lag"] / stats["downloads"]
+    return (f"avg {average / 60:.1f}m, max {stats['max_lag'] / 60:.1f}m, last {stats['last_lag'] / 60:.1f}m "
+            f"over {stats['downloads']} episode(s)")
+
+class AirtimeScheduler:
+    def __init__(self, check, retry_seconds):
+        self.check = check  # Coroutine function called with the list of due miruro_ids, returns the ones it took on
+        self.retry_seconds = retry_seconds
+        self.heap = []
+        self.due = {}  # miruro_id -> due time of its live heap entry
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+        self.checks = set()  # Batches still running, a long download does not hold up series due later
+
+    def start(self):
+        if self.task:
+            return self.task  # on_ready fires again after a reconnect
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    def next_due(self):
+        return min(self.due.values(), default=None)
+
+    def update(self, miruro_id, when):
+        # Called by download.py (on a worker thread) whenever it writes a new airtime
+        if self.loop is None:
+            return  # Not started yet, load() reads it from hue.db
+        self.loop.call_soon_threadsafe(self._push, miruro_id, parse_time(when))
+
+    def retry_later(self, miruro_id):
+        self._push(miruro_id, datetime.datetime.now() + datetime.timedelta(seconds=self.retry_seconds))
+
+    async def load(self, miruro_id=None, retry=False):
+        # Reads airtimes from hue.db, all airing series or just one. With retry, a series that is already
+        # past due (or failed) waits scanInterval instead of coming up again straight away
+        query = '''
+            SELECT miruro_id, next_episode_time, download_failed FROM series
+            WHERE is_airing = 1 AND (next_episode_time IS NOT NULL OR download_failed = 1)
+        '''
+        params = ()
+        if miruro_id is not None:
+            query += ' AND miruro_id = ?'
+            params = (miruro_id,)
+        rows = await db.fetchall_async(query, params)
+        if miruro_id is not None and not rows:
+            self._push(miruro_id, None)  # Finished airing
+        now = datetime.datetime.now()
+        for series_id, next_time, failed in rows:
+            when = parse_time(next_time)
+            if failed or when is None or when <= now:
+                when = now + datetime.timedelta(seconds=self.retry_seconds) if retry else now
+            self._push(series_id, when)
+        return len(rows)
+
+    def _push(self, miruro_id, when):
+        if when is None:
+            self.due.pop(miruro_id, None)
+            return
+        if self.due.get(miruro_id) == when:
+            return
+        self.due[miruro_id] = when
+        heapq.heappush(self.heap, (when, miruro_id))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def _pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, miruro_id = heapq.heappop(self.heap)
+            if self.due.get(miruro_id) == when:
+                del self.due[miruro_id]
+                due.append(miruro_id)
+        return due
+
+    async def _check(self, due):
+        eligible = set(due)
+        try:
+            eligible = set(await self.check(due))
+        except Exception as e:
+            print(f"[!] Scheduler error: {e}")
+        # Picks up the airtimes the downloads wrote. Anything still past due comes back after scanInterval.
+        # Series the check passed over (nobody follows them) are dropped until a new follow loads them again
+        for miruro_id in due:
+            if miruro_id in eligible:
+                await self.load(miruro_id, retry=True)
+
+    async def _run(self):
+        count = await self.load()
+        print(f"[*] Scheduler: tracking {count} airing series, next due {self.next_due() or 'never'}.")
+        while True:
+            self.wakeup.clear()
+            due = self._pop_due(datetime.datetime.now())
+            if due:
+                task = asyncio.create_task(self._check(due))
+                self.checks.add(task)
+                task.add_done_callback(self.checks.discard)
+                continue
+
+            timeout = MAX_SLEEP
+            if self.heap:
+                timeout = min(timeout, max(0.0, (self.heap[0][0] - datetime.datetime.now()).total_seconds()))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,37 @@
+import json
+import os
+import threading
+
+import portalocker
+
+# The small JSON files the modules keep their counters in (browser_pool.json, transfer_stats.json,
+# cache/metadata/stats.json, cache/artwork.json, scheduler_stats.json). update() re-reads the file
+# under a lock that also covers other processes, so the bot's worker threads and a manual download.py
+# run add to the same totals instead of overwriting each other. The new document goes to a temp file
+# that replaces the old one, so a crash mid-write never leaves a truncated file that reads as empty.
+
+LOCK = threading.Lock()
+
+def load(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def update(path, change, label="stats"):
+    # change(data) edits the loaded document in place. Never raises for a file that cannot be written
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with LOCK, open(f"{path}.lock", "a") as lock_file:
+            portalocker.lock(lock_file, portalocker.LOCK_EX)
+            data = load(path)
+            change(data)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump(data, file, indent=4)
+            os.replace(temp_path, path)
+    except OSError as e:
+        print(f"[!] Could not save {label}: {e}")
@@ -0,0 +1,404 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+
+import hosts
+import stats_file
+
+# Streaming HTTP client for the final kwik file. The browser only solves the page and hands over its
+# cookies and form token; the file itself is written chunk by chunk straight to the output path
+# instead of going through Playwright's temp directory first.
+#
+# Bytes land in "<episode>.mp4.part" and are only renamed once the whole file is there. Next to it
+# "<episode>.mp4.part.json" records the direct file URL, the session it needs and how far the
+# transfer got, so a retry (or a job resumed after a restart) only asks for the missing bytes.
+#
+# With segments > 1 the file is preallocated and fetched over that many parallel Range requests, each
+# writing its own slice. Servers that refuse ranges get the single stream instead.
+
+CHUNK_SIZE = 1024 * 1024
+CONNECT_TIMEOUT = 15
+READ_TIMEOUT = 60
+PROGRESS_EVERY = 16 * 1024 * 1024  # Rewrite the .part.json offset after this many bytes
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024  # Smaller files are not worth splitting
+REPORT_EVERY = 1.0  # Seconds between progress callbacks
+STATS_PATH = "transfer_stats.json"  # Throughput per mode, used to report the segmented gain
+
+class TransferError(Exception):
+    pass
+
+class TransferStats:
+    def __init__(self, progress=None):
+        self.bytes = 0  # Bytes received by this call, resumed bytes are not counted
+        self.resumed_from = 0
+        self.expected = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.progress = progress  # Called with these stats at most every REPORT_EVERY seconds while bytes arrive
+        self.reported = 0.0
+
+    def tick(self):
+        if self.progress and time.monotonic() - self.reported >= REPORT_EVERY:
+            self.reported = time.monotonic()
+            self.progress(self)
+
+    @property
+    def seconds(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self):
+        resumed = f", resumed at {format_bytes(self.resumed_from)}" if self.resumed_from else ""
+        return f"{format_bytes(self.bytes)} in {self.seconds:.1f}s ({format_bytes(self.rate)}/s{resumed})"
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024 or unit == "GB":
+            return f"{count:.1f} {unit}"
+        count /= 1024
+
+def record_throughput(mode, stats):
+    if not stats.bytes or stats.seconds <= 0:
+        return
+    def change(totals):
+        entry = totals.setdefault(mode, {"transfers": 0, "bytes": 0, "seconds": 0.0})
+        entry["transfers"] += 1
+        entry["bytes"] += stats.bytes
+        entry["seconds"] += stats.seconds
+    stats_file.update(STATS_PATH, change, "transfer stats")
+
+def average_rate(mode):
+    entry = stats_file.load(STATS_PATH).get(mode)
+    if not entry or entry["seconds"] <= 0:
+        return None
+    return entry["bytes"] / entry["seconds"]
+
+def part_paths(dest):
+    return dest + ".part", dest + ".part.json"
+
+def load_part_info(dest):
+    part_path, info_path = part_paths(dest)
+    if not os.path.exists(part_path) or not os.path.exists(info_path):
+        return None
+    try:
+        with open(info_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def save_part_info(dest, info):
+    try:
+        with open(part_paths(dest)[1], "w") as file:
+            json.dump(info, file, indent=4)
+    except OSError as e:
+        print(f"[!] Could not save transfer progress: {e}")
+
+def discard_part(dest):
+    for path in part_paths(dest):
+        if os.path.exists(path):
+            os.remove(path)
+
+def session_from_page(page, referer):
+    # Same cookies, user agent and referer as the browser tab that passed the kwik checks
+    session = requests.Session()
+    for cookie in page.context.cookies():
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+    session.headers.update({
+        "User-Agent": page.evaluate("() => navigator.userAgent"),
+        "Referer": referer,
+    })
+    return hosts.mount(session)
+
+def session_from_info(info):
+    session = requests.Session()
+    session.headers.update(info.get("headers", {}))
+    for name, value in info.get("cookies", {}).items():
+        session.cookies.set(name, value)
+    return hosts.mount(session)
+
+def check_response(response, url):
+    if response.status_code >= 400:
+        response.close()
+        raise TransferError(f"Server answered {response.status_code} for {url}")
+    if response.headers.get("Content-Type", "").startswith("text/html"):
+        # kwik answers an expired token with its page again instead of an error status
+        response.close()
+        raise TransferError("Server returned a web page instead of the video file.")
+    return response
+
+def open_stream(session, method, url, data=None, headers=None):
+    response = session.request(method, url, data=data, headers=headers, stream=True,
+                               allow_redirects=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    return check_response(response, url)
+
+def resolve_file_url(session, method, url, data=None):
+    # The form post answers with a redirect to the file itself. Returns (file_url, None), or
+    # (None, response) when the server sends the body right away and there is no URL to resume from
+    response = session.request(method, url, data=data, stream=True, allow_redirects=False,
+                               timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if response.is_redirect and response.headers.get("Location"):
+        location = urljoin(url, response.headers["Location"])
+        response.close()
+        return location, None
+    return None, check_response(response, url)
+
+def total_size(response, offset):
+    # Full file size from Content-Range on a 206 or Content-Length on a 200
+    if response.status_code == 206:
+        match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != offset:
+            raise TransferError(f"Server resumed at the wrong offset: {response.headers.get('Content-Range')}")
+        return int(match.group(2)) if match.group(2) != "*" else None
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None  # Content-Length counts encoded bytes, so it can only be checked on unencoded bodies
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+def write_stream(response, file, stats, cancelled=None, on_progress=None):
+    since_progress = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if cancelled and cancelled():
+            raise TransferError("Transfer cancelled.")
+        if chunk:
+            file.write(chunk)
+            stats.bytes += len(chunk)
+            stats.tick()
+            since_progress += len(chunk)
+            if on_progress and since_progress >= PROGRESS_EVERY:
+                file.flush()
+                on_progress()
+                since_progress = 0
+
+def fetch_into_part(session, file_url, dest, info, stats, response=None, cancelled=None):
+    # Appends to the .part file, asking only for the bytes that are missing. Renames it to dest once complete
+    part_path = part_paths(dest)[0]
+    # file_url is None when the body came straight from the form post and cannot be requested again.
+    # A segmented .part is preallocated, so its size says nothing about progress. Every kwik form post
+    # hands out a fresh URL, so a .part from another URL is continued too when the server vouches for
+    # it with the recorded validator (If-Range) and the size matches, like fetch_segmented does
+    same_url = info.get("url") == file_url
+    resumable = file_url and not info.get("segments") and (same_url or (info.get("validator") and info.get("size")))
+    offset = os.path.getsize(part_path) if resumable and os.path.exists(part_path) else 0
+    recorded_size = info.get("size")
+
+    if response is None:
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if info.get("validator"):
+                headers["If-Range"] = info["validator"]  # Only resume if the file did not change on the server
+        response = open_stream(session, "GET", file_url, headers=headers)
+
+    with response:
+        if response.status_code != 206:
+            offset = 0  # Server ignored the range or the file changed, start over
+        stats.resumed_from = offset
+        stats.expected = total_size(response, offset)
+        if offset and not same_url and stats.expected != recorded_size:
+            discard_part(dest)  # Not the file the .part came from, the next attempt starts over
+            raise TransferError(f"File is {stats.expected} bytes but the .part was for {recorded_size} bytes.")
+        info.pop("segments", None)
+        info.update({
+            "url": file_url,
+            "size": stats.expected,
+            "validator": response.headers.get("ETag") or response.headers.get("Last-Modified"),
+            "cookies": session.cookies.get_dict(),
+            "headers": {key: session.headers[key] for key in ("User-Agent", "Referer") if key in session.headers},
+        })
+
+        def record_offset():
+            info["offset"] = offset + stats.bytes
+            save_part_info(dest, info)
+
+        record_offset()
+        with open(part_path, "ab" if offset else "wb") as file:
+            try:
+                write_stream(response, file, stats, cancelled, on_progress=record_offset)
+            finally:
+                file.flush()
+                record_offset()
+    stats.finished = time.monotonic()
+
+    received = offset + stats.bytes
+    if stats.expected is not None and received != stats.expected:
+        raise TransferError(f"Received {received} bytes but the file is {stats.expected} bytes.")
+    os.replace(part_path, dest)
+    discard_part(dest)
+    record_throughput("single", stats)
+    return stats
+
+def probe_ranges(session, file_url):
+    # Returns (size, validator) if the server answers a one byte Range request, otherwise None
+    response = session.get(file_url, headers={"Range": "bytes=0-0"}, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    with check_response(response, file_url):
+        if response.status_code != 206:
+            return None
+        match = re.match(r'bytes 0-0/(\d+)', response.headers.get("Content-Range", ""))
+        if not match:
+            return None
+        return int(match.group(1)), response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+def split_range(size, segments):
+    step = -(-size // segments)
+    return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+def fetch_segmented(session, file_url, dest, info, segments, cancelled=None, progress=None):
+    # Fetches the file over several Range requests into a preallocated .part. Each entry of
+    # info["segments"] is [first byte, last byte, bytes done]. Returns None if the server refuses ranges
+    part_path = part_paths(dest)[0]
+    single_stream = not info.get("segments") and os.path.exists(part_path)
+    if single_stream and info.get("url") == file_url:
+        return None  # A single stream is already part way, keep going with that one
+
+    probe = probe_ranges(session, file_url)
+    if not probe:
+        print("[*] Server does not accept range requests, using a single stream.")
+        return None
+    size, validator = probe
+    if size < MIN_SEGMENT_SIZE * 2:
+        return None
+    if single_stream and info.get("size") == size and validator and info.get("validator") == validator:
+        # A single stream of an earlier form post got part way into the same file, fetch_into_part
+        # continues it (with If-Range) instead of starting the segments over from nothing
+        return None
+
+    # The form post hands out a fresh URL every time, earlier segments still count if the file is the same
+    same_file = info.get("segments") and info.get("size") == size and validator and info.get("validator") == validator
+    if not (same_file and os.path.exists(part_path)):
+        with open(part_path, "wb") as file:
+            file.truncate(size)
+        info.clear()
+        info["segments"] = split_range(size, segments)
+    info.update({
+        "url": file_url,
+        "size": size,
+        "validator": validator,
+        "cookies": session.cookies.get_dict(),
+        "headers": {key: session.headers[key] for key in ("User-Agent", "Referer") if key in session.headers},
+    })
+
+    stats = TransferStats(progress)
+    stats.expected = size
+    stats.resumed_from = sum(segment[2] for segment in info["segments"])
+    save_part_info(dest, info)
+    lock = threading.Lock()
+    failed = threading.Event()
+    unsaved = [0]
+    segment_rates = []
+
+    def run_segment(segment):
+        start, end = segment[0], segment[1]
+        if start + segment[2] > end:
+            return
+        started = time.monotonic()
+        received = 0
+        headers = {"Range": f"bytes={start + segment[2]}-{end}"}
+        if validator:
+            headers["If-Range"] = validator
+        # One session per thread, requests sessions are not safe to share
+        with open_stream(session_from_info(info), "GET", file_url, headers=headers) as response:
+            if response.status_code != 206:
+                raise TransferError("Server stopped honouring range requests.")
+            total_size(response, start + segment[2])  # Checks the server resumed at the right byte
+            with open(part_path, "r+b") as file:
+                file.seek(start + segment[2])
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if failed.is_set() or (cancelled and cancelled()):
+                        raise TransferError("Transfer cancelled.")
+                    if not chunk:
+                        continue
+                    if start + segment[2] + len(chunk) > end + 1:
+                        raise TransferError(f"Segment {start}-{end} received more data than requested.")
+                    file.write(chunk)
+                    file.flush()  # Only count bytes that reached the file, so a crash never records unwritten data
+                    received += len(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        stats.bytes += len(chunk)
+                        stats.tick()
+                        unsaved[0] += len(chunk)
+                        if unsaved[0] >= PROGRESS_EVERY:
+                            save_part_info(dest, info)
+                            unsaved[0] = 0
+        if start + segment[2] != end + 1:
+            raise TransferError(f"Segment {start}-{end} ended after {segment[2]} of {end - start + 1} bytes.")
+        segment_rates.append(received / max(time.monotonic() - started, 1e-6))
+
+    with ThreadPoolExecutor(max_workers=len(info["segments"])) as pool:
+        futures = [pool.submit(run_segment, segment) for segment in info["segments"]]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed.set()  # Stop the other segments, their progress is kept for the retry
+                errors.append(e)
+    stats.finished = time.monotonic()
+    save_part_info(dest, info)
+    if errors:
+        raise errors[0]
+
+    received = sum(segment[2] for segment in info["segments"])
+    if received != size:
+        raise TransferError(f"Received {received} bytes but the file is {size} bytes.")
+    os.replace(part_path, dest)
+    discard_part(dest)
+    record_throughput("segmented", stats)
+    report_gain(stats, segment_rates, len(info["segments"]))
+    return stats
+
+def report_gain(stats, segment_rates, segments):
+    single = average_rate("single")
+    if single:
+        print(f"[*] Segmented transfer over {segments} connections: {format_bytes(stats.rate)}/s, "
+              f"{stats.rate / single:.1f}x the average single-stream rate ({format_bytes(single)}/s)")
+    elif segment_rates:
+        per_connection = sum(segment_rates) / len(segment_rates)
+        print(f"[*] Segmented transfer over {segments} connections: {format_bytes(stats.rate)}/s, "
+              f"{stats.rate / per_connection:.1f}x one connection ({format_bytes(per_connection)}/s, no single-stream history yet)")
+
+def download_to_file(session, method, url, dest, data=None, cancelled=None, segments=1, progress=None):
+    # Posts the form (or fetches url) and streams the file into dest via a .part file.
+    # A .part left by an earlier attempt is continued with Range requests when the server allows it
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    info = load_part_info(dest) or {}
+    file_url, response = resolve_file_url(session, method, url, data=data)
+    if file_url is None:
+        info = {}  # No URL to resume from later, the body is already on its way
+    elif segments > 1:
+        stats = fetch_segmented(session, file_url, dest, info, segments, cancelled=cancelled, progress=progress)
+        if stats:
+            return stats
+    return fetch_into_part(session, file_url, dest, info, TransferStats(progress), response=response, cancelled=cancelled)
+
+def resume_direct(dest, cancelled=None, segments=1, progress=None):
+    # Continues a .part straight from the recorded file URL, skipping the browser entirely.
+    # Returns None if there is nothing to resume or the URL no longer works
+    info = load_part_info(dest)
+    if not info or not info.get("url"):
+        return None
+    if info.get("segments"):
+        offset = sum(segment[2] for segment in info["segments"])
+    else:
+        offset = os.path.getsize(part_paths(dest)[0])
+    print(f"[*] Resuming {os.path.basename(dest)} at {format_bytes(offset)} from the recorded file URL...")
+    try:
+        session = session_from_info(info)
+        if info.get("segments") or segments > 1:
+            stats = fetch_segmented(session, info["url"], dest, info, max(segments, len(info.get("segments", []))),
+                                    cancelled=cancelled, progress=progress)
+            if stats:
+                return stats
+        return fetch_into_part(session, info["url"], dest, info, TransferStats(progress), cancelled=cancelled)
+    except (TransferError, requests.RequestException) as e:
+        print(f"[!] Direct resume failed, falling back to the kwik page: {e}")
+        return None